@@ -1,17 +1,31 @@
+import asyncio
 import json
+import logging
 import os
+import time
+from collections import OrderedDict
 
+from telethon.errors import ChannelPrivateError, ChannelInvalidError, PeerIdInvalidError
 from telethon.tl.types import User, Channel, Chat
 
+logger = logging.getLogger(__name__)
+
+# stored for missing fields by earlier versions of the cache file
+LEGACY_MISSING_FIELD = 'unknown'
+
 
 class CachedUser:
+    __slots__ = ('id', 'username', 'title', 'is_user', 'is_chat', 'is_channel', 'cached_at')
+
     def __init__(self, chat):
         self.id = chat.id
-        self.username = getattr(chat, 'username', 'unknown')
-        self.title = getattr(chat, 'title', 'unknown') or getattr(chat, 'name', 'unknown')
+        # None for fields the peer doesn't have, the names are looked up in the scan data
+        self.username = getattr(chat, 'username', None)
+        self.title = getattr(chat, 'title', None) or getattr(chat, 'name', None)
         self.is_user = isinstance(chat, User)
         self.is_chat = isinstance(chat, Chat)
         self.is_channel = isinstance(chat, Channel)
+        self.cached_at = time.time()
 
     def to_dict(self):
         return {
@@ -21,44 +35,110 @@ class CachedUser:
             'is_user': self.is_user,
             'is_chat': self.is_chat,
             'is_channel': self.is_channel,
+            'cached_at': self.cached_at,
         }
 
     @classmethod
     def from_dict(cls, data):
         instance = cls.__new__(cls)
         instance.id = data['id']
-        instance.username = data['username']
-        instance.title = data['title']
+        instance.username = data['username'] if data['username'] != LEGACY_MISSING_FIELD else None
+        instance.title = data['title'] if data['title'] != LEGACY_MISSING_FIELD else None
         instance.is_user = data['is_user']
         instance.is_chat = data['is_chat']
         instance.is_channel = data['is_channel']
+        instance.cached_at = data.get('cached_at', 0)
         return instance
 
 
 class ChatCache:
-    def __init__(self, cache_file, client):
+    """Names and types of peers by ID, shared by everything resolving peers during a scan.
+
+    Entries expire after ttl seconds and the least recently used ones are evicted above max_size. Concurrent
+    lookups of the same peer share one get_entity request, peers that can't be resolved are remembered for the
+    run. The file is rewritten at most every flush_interval seconds, atomically, and on close."""
+
+    def __init__(self, cache_file, client, limiter=None, ttl=7 * 24 * 3600, max_size=50000, flush_interval=30.0):
         self.cache_file = cache_file
         self.client = client
+        self.limiter = limiter
+        self.ttl = ttl
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.chat_cache: OrderedDict[str, CachedUser] = OrderedDict()
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self._unresolved = set()
+        self._dirty = False
+        self._last_flush = time.monotonic()
         if os.path.exists(self.cache_file):
             with open(self.cache_file, 'r') as f:
-                self.chat_cache = {key: CachedUser.from_dict(value) for key, value in json.load(f).items()}
-        else:
-            self.chat_cache = {}
+                for key, value in json.load(f).items():
+                    self.chat_cache[key] = CachedUser.from_dict(value)
 
     def save_chat_cache(self):
-        with open(self.cache_file, 'w') as f:
+        temp_file = f"{self.cache_file}.tmp"
+        with open(temp_file, 'w') as f:
             json.dump({key: value.to_dict() for key, value in self.chat_cache.items()}, f)
+        os.replace(temp_file, self.cache_file)
+        self._dirty = False
+        self._last_flush = time.monotonic()
 
-    async def get_chat_entity(self, peer_id):
-        peer_id_str = str(peer_id)
-        if peer_id_str in self.chat_cache:
-            return self.chat_cache[peer_id_str]
-        else:
-            chat = await self.client.get_entity(peer_id)
-            cached_user = CachedUser(chat)
-            self.chat_cache[peer_id_str] = cached_user
+    def close(self):
+        if self._dirty:
+            self.save_chat_cache()
+
+    def get(self, peer_id):
+        """Cached entry of the peer without requests, None if it's missing or expired."""
+        key = str(peer_id)
+        cached_user = self.chat_cache.get(key)
+        if cached_user is None:
+            return None
+        if time.time() - cached_user.cached_at > self.ttl:
+            del self.chat_cache[key]
+            return None
+        self.chat_cache.move_to_end(key)
+        return cached_user
+
+    def put(self, peer_id, chat):
+        """Caches an entity already at hand, e.g. a dialog entity."""
+        cached_user = CachedUser(chat)
+        key = str(peer_id)
+        self.chat_cache[key] = cached_user
+        self.chat_cache.move_to_end(key)
+        self._unresolved.discard(key)
+        while len(self.chat_cache) > self.max_size:
+            self.chat_cache.popitem(last=False)
+        self._dirty = True
+        if time.monotonic() - self._last_flush >= self.flush_interval:
             self.save_chat_cache()
+        return cached_user
+
+    async def get_chat_entity(self, peer_id):
+        """Cached entry of the peer, requested from Telegram on a miss. None if the peer can't be resolved."""
+        cached_user = self.get(peer_id)
+        if cached_user is not None:
             return cached_user
+        key = str(peer_id)
+        if key in self._unresolved:
+            return None
+        in_flight = self._in_flight.get(key)
+        if in_flight is None:
+            in_flight = asyncio.ensure_future(self.__fetch(peer_id))
+            self._in_flight[key] = in_flight
+            in_flight.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(in_flight)
+
+    async def __fetch(self, peer_id):
+        try:
+            if self.limiter is not None:
+                chat = await self.limiter.call(self.client.get_entity, peer_id)
+            else:
+                chat = await self.client.get_entity(peer_id)
+        except (ValueError, TypeError, ChannelPrivateError, ChannelInvalidError, PeerIdInvalidError) as e:
+            logger.debug("Can't resolve peer %s: %s", peer_id, e)
+            self._unresolved.add(str(peer_id))
+            return None
+        return self.put(peer_id, chat)
 
 
 class CachedProcessedUser:
@@ -96,18 +176,82 @@ class CachedProcessedUser:
 
 
 class ProcessedUsersCache:
-    def __init__(self, cache_file):
+    """Processed users stored as a JSON snapshot plus an append-only journal of updates since it.
+
+    An update appends one line to the journal, fsync runs once per fsync_every updates or fsync_interval seconds
+    (and on close). When the journal outgrows the snapshot it is compacted into a new snapshot, so updates cost
+    constant amortized time. A torn last line left by a crash is ignored on load."""
+
+    def __init__(self, cache_file, fsync_every=100, fsync_interval=1.0, compact_after=1000):
         self.cache_file = cache_file
+        self.journal_file = f"{cache_file}.journal"
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.compact_after = compact_after
+        self.processed_users_cache = {}
         if os.path.exists(self.cache_file):
             with open(self.cache_file, 'r') as f:
                 self.processed_users_cache = {key: CachedProcessedUser.from_dict(value) for key, value in
                                               json.load(f).items()}
-        else:
-            self.processed_users_cache = {}
+        self._journal_entries = self.__replay_journal()
+        self._journal = open(self.journal_file, 'a')
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def __replay_journal(self):
+        if not os.path.exists(self.journal_file):
+            return 0
+        entries = 0
+        complete_size = 0
+        with open(self.journal_file, 'rb') as f:
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError("incomplete entry")
+                    data = json.loads(line)
+                except ValueError:
+                    logger.warning("Dropping a broken entry at the end of %s", self.journal_file)
+                    break
+                self.processed_users_cache[str(data['id'])] = CachedProcessedUser.from_dict(data)
+                complete_size += len(line)
+                entries += 1
+        # later entries are appended after the last complete one
+        os.truncate(self.journal_file, complete_size)
+        return entries
+
+    def __append(self, data):
+        self._journal.write(json.dumps(data) + '\n')
+        self._journal_entries += 1
+        self._unsynced += 1
+        if self._journal_entries >= max(self.compact_after, len(self.processed_users_cache)):
+            self.save_processed_users_cache()
+        elif self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
 
     def save_processed_users_cache(self):
-        with open(self.cache_file, 'w') as f:
+        """Compacts the journal into a new snapshot."""
+        temp_file = f"{self.cache_file}.tmp"
+        with open(temp_file, 'w') as f:
             json.dump({key: value.to_dict() for key, value in self.processed_users_cache.items()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, self.cache_file)
+        self._journal.close()
+        self._journal = open(self.journal_file, 'w')
+        self._journal_entries = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if not self._journal.closed:
+            self.sync()
+            self._journal.close()
 
     def get_processed_user_version(self, user_id):
         user_id_str = str(user_id)
@@ -121,9 +265,9 @@ class ProcessedUsersCache:
 
     def update_processed(self, user_id, version, username, name, total_count, deleted_count):
         user_id_str = str(user_id)
-        self.processed_users_cache[user_id_str] = CachedProcessedUser(user_id, version, username, name, total_count,
-                                                                      deleted_count)
-        self.save_processed_users_cache()
+        cached_user = CachedProcessedUser(user_id, version, username, name, total_count, deleted_count)
+        self.processed_users_cache[user_id_str] = cached_user
+        self.__append(cached_user.to_dict())
 
     def clear_cache(self):
         self.processed_users_cache = {}
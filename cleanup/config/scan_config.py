@@ -1,3 +1,5 @@
+import hashlib
+import os
 import re
 from typing import Union
 
@@ -6,11 +8,26 @@ from datetime import datetime, timedelta, timezone
 
 from cleanup.config.common_flags import EnabledFlag, DeleteFlag, AskFlag
 
+MODE_ONLINE = "online"
+MODE_OFFLINE = "offline"
+MODE_APPLY_PLAN = "apply_plan"
+
+SEARCH_MODE_FULL = "full"
+SEARCH_MODE_SEARCH = "search"
+SEARCH_MODE_AUTO = "auto"
+
+CACHE_FORMAT_COMPACT = "compact"
+CACHE_FORMAT_FULL = "full"
+
+STORAGE_BACKEND_POSTGRES = "postgres"
+STORAGE_BACKEND_SQLITE = "sqlite"
+
 class Config:
     def __init__(self):
         self.paths = PathsConfig()
         self.telegram = TelegramConfig()
         self.instagram = InstagramConfig()
+        self.storage = StorageConfig()
 
     def __str__(self):
         yaml_str = yaml.dump(self.__dict__, default_flow_style=False, sort_keys=False, indent=2)
@@ -19,19 +36,59 @@ class Config:
 class TelegramConfig:
     def __init__(self):
         self.enabled = True
+        self.mode = MODE_ONLINE
         self.api_id = ""
         self.api_hash = ""
         self.from_date = (datetime.now(timezone.utc) - timedelta(weeks=1)).replace(hour=0, minute=0, second=0, microsecond=0)
         self.to_date = datetime.now(timezone.utc).replace(hour=23, minute=59, second=59, microsecond=999999)
         self.cache_peers = False
         self.cache_messages = False
+        self.cache_format = CACHE_FORMAT_COMPACT
+        self.cache_full_json = False
+        self.dialog_workers = 1
+        self.resume = False
+        self.incremental = False
+        self.takeout = False
+        self.offline = TelegramOfflineConfig()
         self.dialogs = TelegramDialogsConfig()
         self.messages = TelegramMessagesConfig()
+        self.fuzzy_titles = TelegramFuzzyTitlesConfig()
+
+    def scan_fingerprint(self):
+        """Hash of the settings that decide which dialogs a scan checks and how. The dates are left out, the storage
+        keeps the scanned range next to it, see store_user_dialog."""
+        settings = [self.dialogs, self.messages]
+        if self.fuzzy_titles.enabled:
+            # only when enabled, so fingerprints of existing scans stay the same
+            settings.append(self.fuzzy_titles)
+        scan_settings = yaml.dump(settings, sort_keys=True)
+        return hashlib.sha1(scan_settings.encode()).hexdigest()
+
+class TelegramFuzzyTitlesConfig(EnabledFlag, DeleteFlag):
+    def __init__(self):
+        EnabledFlag.__init__(self, enabled=False)
+        # forwards whose source only matched by a similar name are reported unless this is set too
+        DeleteFlag.__init__(self, delete=False)
+        self.max_distance = 2
+
+class TelegramOfflineConfig:
+    def __init__(self):
+        self.workers = os.cpu_count() or 1
+        self.pushdown = False
+
+class StorageConfig:
+    def __init__(self):
+        self.backend = STORAGE_BACKEND_POSTGRES
+        self.path = os.path.join(".cache", "messages.db")
+        self.dsn = "dbname=messages_db user=postgres password=password host=localhost port=5499"
+        self.pool_size = 5
 
 class PathsConfig:
     def __init__(self):
         self.cache_dir = ".cache"
         self.scan_data_dir = "scan-data"
+        self.scan_data_snapshot = "scan-data.snapshot"
+        self.scan_data_reload_interval = 60
         self.scan_data_suffixes = ScanDataSuffixesConfig()
 
 class ScanDataSuffixesConfig:
@@ -72,6 +129,7 @@ class TelegramMessagesConfig:
         self.enabled = False
         self.delete = False
         self.ask = False
+        self.search_mode = SEARCH_MODE_FULL
         self.checks = TelegramMessageChecksConfig()
 
 class TelegramDialogSetting(EnabledFlag, AskFlag):
@@ -114,6 +172,8 @@ def load_config(filename: str) -> Union[Config, tuple[Config, bool]]:
             paths_data = data.get('paths', {})
             config.paths.cache_dir = paths_data.get('cache_dir', config.paths.cache_dir)
             config.paths.scan_data_dir = paths_data.get('scan_data_dir', "scan-data")
+            config.paths.scan_data_snapshot = paths_data.get('scan_data_snapshot', config.paths.scan_data_snapshot)
+            config.paths.scan_data_reload_interval = paths_data.get('scan_data_reload_interval', config.paths.scan_data_reload_interval)
             scan_data_suffixes_data = paths_data.get('scan_data_suffixes', {})
             config.paths.scan_data_suffixes.telegram_ids = scan_data_suffixes_data.get('telegram_ids', "tg-ids.txt")
             config.paths.scan_data_suffixes.telegram_user_names = scan_data_suffixes_data.get('telegram_user_names', "tg-user-names.txt")
@@ -127,6 +187,9 @@ def load_config(filename: str) -> Union[Config, tuple[Config, bool]]:
 
             telegram_data = data.get('telegram', {})
             config.telegram.enabled = telegram_data.get('enabled', True)
+            config.telegram.mode = telegram_data.get('mode', MODE_ONLINE)
+            if config.telegram.mode not in (MODE_ONLINE, MODE_OFFLINE, MODE_APPLY_PLAN):
+                raise ValueError(f"Unknown telegram.mode: {config.telegram.mode}")
             config.telegram.api_id = telegram_data.get('api_id', config.telegram.api_id)
             config.telegram.api_hash = telegram_data.get('api_hash', config.telegram.api_hash)
             config.telegram.from_date = telegram_data.get('from_date', config.telegram.from_date)
@@ -137,6 +200,24 @@ def load_config(filename: str) -> Union[Config, tuple[Config, bool]]:
                 config.telegram.to_date = datetime.strptime(config.telegram.to_date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
             config.telegram.cache_peers = telegram_data.get('cache_peers', False)
             config.telegram.cache_messages = telegram_data.get('cache_messages', False)
+            config.telegram.cache_format = telegram_data.get('cache_format', CACHE_FORMAT_COMPACT)
+            if config.telegram.cache_format not in (CACHE_FORMAT_COMPACT, CACHE_FORMAT_FULL):
+                raise ValueError(f"Unknown telegram.cache_format: {config.telegram.cache_format}")
+            config.telegram.cache_full_json = telegram_data.get('cache_full_json', False)
+            config.telegram.dialog_workers = telegram_data.get('dialog_workers', config.telegram.dialog_workers)
+            config.telegram.resume = telegram_data.get('resume', False)
+            config.telegram.incremental = telegram_data.get('incremental', False)
+            config.telegram.takeout = telegram_data.get('takeout', False)
+            offline_data = telegram_data.get('offline', {})
+            config.telegram.offline.workers = offline_data.get('workers', config.telegram.offline.workers)
+            config.telegram.offline.pushdown = offline_data.get('pushdown', False)
+
+            fuzzy_titles_data = telegram_data.get('fuzzy_titles', {})
+            config.telegram.fuzzy_titles.enabled = fuzzy_titles_data.get('enabled', False)
+            config.telegram.fuzzy_titles.delete = fuzzy_titles_data.get('delete', False)
+            config.telegram.fuzzy_titles.max_distance = fuzzy_titles_data.get('max_distance', config.telegram.fuzzy_titles.max_distance)
+            if config.telegram.fuzzy_titles.max_distance < 0:
+                raise ValueError("telegram.fuzzy_titles.max_distance can't be negative")
 
             dialogs_data = telegram_data.get('dialogs', {})
             config.telegram.dialogs.users.enabled = dialogs_data.get('users', {}).get('enabled', False)
@@ -153,6 +234,9 @@ def load_config(filename: str) -> Union[Config, tuple[Config, bool]]:
             config.telegram.messages.enabled = messages_data.get('enabled', False)
             config.telegram.messages.delete = messages_data.get('delete', False)
             config.telegram.messages.ask = messages_data.get('ask', False)
+            config.telegram.messages.search_mode = messages_data.get('search_mode', SEARCH_MODE_FULL)
+            if config.telegram.messages.search_mode not in (SEARCH_MODE_FULL, SEARCH_MODE_SEARCH, SEARCH_MODE_AUTO):
+                raise ValueError(f"Unknown telegram.messages.search_mode: {config.telegram.messages.search_mode}")
 
             checks_data = messages_data.get('checks', {})
             config.telegram.messages.checks.accounts_references.enabled = checks_data.get('accounts_references', {}).get('enabled', False)
@@ -168,6 +252,14 @@ def load_config(filename: str) -> Union[Config, tuple[Config, bool]]:
             config.telegram.messages.checks.keywords.delete = checks_data.get('keywords', {}).get('delete', False)
             config.telegram.messages.checks.keywords.ask = checks_data.get('keywords', {}).get('ask', False)
 
+            storage_data = data.get('storage', {})
+            config.storage.backend = storage_data.get('backend', config.storage.backend)
+            if config.storage.backend not in (STORAGE_BACKEND_POSTGRES, STORAGE_BACKEND_SQLITE):
+                raise ValueError(f"Unknown storage.backend: {config.storage.backend}")
+            config.storage.path = storage_data.get('path', os.path.join(config.paths.cache_dir, "messages.db"))
+            config.storage.dsn = storage_data.get('dsn', config.storage.dsn)
+            config.storage.pool_size = storage_data.get('pool_size', config.storage.pool_size)
+
             instagram_data = data.get('instagram', {})
             config.instagram.enabled = instagram_data.get('enabled', True)
             config.instagram.data_dir = instagram_data.get('data_dir', "instagram-user-data")
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Telegram accepts at most 100 message IDs per messages.deleteMessages / channels.deleteMessages call
+MAX_DELETE_BATCH = 100
+
+
+class DeleteQueue:
+    """Collects message IDs of one chat and deletes them in background batches while the chat is being scanned.
+    on_deleted is awaited with the message IDs of every deleted batch."""
+
+    def __init__(self, client, chat, limiter, flush_interval=5.0, batch_size=MAX_DELETE_BATCH, on_deleted=None):
+        self.client = client
+        self.chat = chat
+        self.limiter = limiter
+        self.on_deleted = on_deleted
+        self.flush_interval = flush_interval
+        self.batch_size = min(batch_size, MAX_DELETE_BATCH)
+        self.pending: list[int] = []
+        self.deleted_count = 0
+        self.failed_count = 0
+        self._tasks = set()
+        self._timer = None
+
+    def add(self, message_id):
+        self.pending.append(message_id)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """Starts background deletion of everything pending."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self.pending:
+            batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+            task = asyncio.ensure_future(self._delete(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _delete(self, batch):
+        try:
+            await self.limiter.call(self.client.delete_messages, self.chat, batch)
+        except Exception:
+            logger.exception("Failed deleting %s messages in chat %s", len(batch), getattr(self.chat, 'id', self.chat))
+            self.failed_count += len(batch)
+            return
+        self.deleted_count += len(batch)
+        if self.on_deleted is not None:
+            try:
+                await self.on_deleted(batch)
+            except Exception:
+                logger.exception("Failed recording %s deleted messages", len(batch))
+
+    async def drain(self):
+        """Flushes pending deletions and waits until every started batch is done."""
+        self.flush()
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks))
+
+    async def close(self) -> int:
+        """Drains the queue and returns the number of deleted messages."""
+        await self.drain()
+        return self.deleted_count
@@ -1,3 +1,5 @@
+import hashlib
+import json
 import os
 import string
 from enum import Enum
@@ -5,6 +7,7 @@ import glob
 from typing import Tuple, List, Dict, Any
 
 from cleanup.config.scan_config import load_config, Config
+from cleanup.docextract.title_matcher import TitleMatcher
 
 
 class ScanDataType(Enum):
@@ -62,14 +65,156 @@ class ScanDataEntry:
         return f"{self.data} ({self.data_type.to_str()})"
 
 
+CHANNEL_ID_OFFSET = 1000000000000
+
+
+def normalize_tg_id(value) -> int:
+    """Reduces bare, negative and -100-prefixed Telegram IDs to the bare ID, 0 if value is not an ID."""
+    try:
+        peer_id = abs(int(value))
+    except (TypeError, ValueError):
+        return 0
+    if peer_id > CHANNEL_ID_OFFSET:
+        peer_id -= CHANNEL_ID_OFFSET
+    return peer_id
+
+
+# types ScanDataIndex looks up, in the order their entries take precedence
+INDEXED_TYPES = (ScanDataType.TG_ID, ScanDataType.TG_IGNORED_ID, ScanDataType.TG_USERNAME, ScanDataType.TG_USER_NAME)
+
+
+class ScanDataIndex:
+    """Hash lookups over scan data for dialog and forward checks."""
+
+    def __init__(self, data_by_type: dict[ScanDataType, list[ScanDataEntry]]):
+        self.ids: dict[int, ScanDataEntry] = {}
+        self.ignored_ids: set[int] = set()
+        self.usernames: dict[str, ScanDataEntry] = {}
+        self.names: dict[str, ScanDataEntry] = {}
+        # fuzzy lookups over the names, see build_titles
+        self.titles = None
+
+        for data_type in INDEXED_TYPES:
+            for entry in data_by_type.get(data_type, []):
+                self.__add(entry)
+
+    def __key(self, entry):
+        """(table, key) the entry is indexed under, None if it isn't indexed."""
+        if entry.data_type in (ScanDataType.TG_ID, ScanDataType.TG_IGNORED_ID):
+            peer_id = normalize_tg_id(entry.data)
+            if not peer_id:
+                return None
+            return (self.ids if entry.data_type == ScanDataType.TG_ID else self.ignored_ids), peer_id
+        if entry.data_type == ScanDataType.TG_USERNAME:
+            return self.usernames, entry.data
+        if entry.data_type == ScanDataType.TG_USER_NAME:
+            return self.names, entry.data
+        return None
+
+    def __add(self, entry):
+        table_key = self.__key(entry)
+        if table_key is None:
+            return
+        table, key = table_key
+        if table is self.ignored_ids:
+            table.add(key)
+        else:
+            table.setdefault(key, entry)
+
+    def updated(self, data_by_type, added, removed) -> 'ScanDataIndex':
+        """Copy of the index with entries added and removed, data_by_type is the scan data after the change."""
+        index = ScanDataIndex({})
+        index.ids, index.ignored_ids = dict(self.ids), set(self.ignored_ids)
+        index.usernames, index.names = dict(self.usernames), dict(self.names)
+        # keys of removed entries can still be held by another entry, e.g. the same ID with the -100 prefix
+        affected = set()
+        for entry in removed:
+            table_key = index.__key(entry)
+            if table_key is None:
+                continue
+            table, key = table_key
+            if table is index.ignored_ids:
+                table.discard(key)
+            elif table.get(key) is entry:
+                del table[key]
+            else:
+                continue
+            affected.add((entry.data_type, key))
+        for data_type in {data_type for data_type, _ in affected}:
+            for entry in data_by_type.get(data_type, []):
+                table_key = index.__key(entry)
+                if table_key is not None and (data_type, table_key[1]) in affected:
+                    index.__add(entry)
+        for entry in added:
+            index.__add(entry)
+        if self.titles is not None:
+            # names whose entry changed, the titles of the others are kept
+            keys = {entry.data for entry in (*added, *removed) if entry.data_type == ScanDataType.TG_USER_NAME}
+            changed = [key for key in keys if self.names.get(key) is not index.names.get(key)]
+            index.titles = self.titles.updated(added=[index.names[key] for key in changed if key in index.names],
+                                               removed=[self.names[key] for key in changed if key in self.names])
+        return index
+
+    def is_ignored(self, peer_id) -> bool:
+        return normalize_tg_id(peer_id) in self.ignored_ids
+
+    def find_id(self, *peer_ids):
+        for peer_id in peer_ids:
+            entry = self.ids.get(normalize_tg_id(peer_id))
+            if entry:
+                return entry
+        return None
+
+    def find_username(self, *usernames):
+        for username in usernames:
+            if username and username.lower() in self.usernames:
+                return self.usernames[username.lower()]
+        return None
+
+    def find_name(self, *names):
+        for name in names:
+            if name and name.lower() in self.names:
+                return self.names[name.lower()]
+        return None
+
+    def build_titles(self):
+        """Builds the fuzzy lookups over the names. It takes seconds for large scan data, ScanData builds them
+        while loading when fuzzy_titles is enabled, otherwise find_similar_name builds them on first use."""
+        if self.titles is None:
+            self.titles = TitleMatcher(self.names.values())
+        return self.titles
+
+    def find_similar_name(self, *names, max_distance=2):
+        """Like find_name, but also finds names written with other quotes, emoji, look-alike letters, in the other
+        alphabet or with up to max_distance typos."""
+        self.build_titles()
+        for name in names:
+            entry = self.titles.find(name, max_distance)
+            if entry:
+                return entry
+        return None
+
+
 class ScanData:
+    """Scan data entries loaded from the scan data files, with lookups and the matcher built over them.
+
+    A loaded ScanData isn't changed, reload returns a new version so scans can switch to it between messages."""
+
     def __init__(self, config: Config):
         self.config = config
         self.data: list[ScanDataEntry] = []
         self.data_by_type: dict[ScanDataType, list[ScanDataEntry]] = {}
+        self.index = ScanDataIndex({})
+        # matcher compiled together with the data, e.g. mapped from a snapshot; None builds one from the data
+        self.matcher = None
+        # [data_type, path, size, mtime_ns, sha1] of every file the data was loaded from
+        self.sources = []
+        self.version = None
+        # (added, removed) entry counts compared to the version it was reloaded from
+        self.changes = (0, 0)
 
-
-    def __load_scan_data(self) -> tuple[list[ScanDataEntry], dict[ScanDataType, list[ScanDataEntry]]]:
+    def source_files(self) -> list[tuple[ScanDataType, str]]:
+        """(data_type, path) of every scan data file, in load order."""
         scan_data_dir = self.config.paths.scan_data_dir
         suffixes = self.config.paths.scan_data_suffixes
 
@@ -85,36 +230,110 @@ class ScanData:
             ScanDataType.INSTAGRAM_NAME: suffixes.instagram_names
         }
 
+        return [(data_type, file_path) for data_type, suffix in data_files.items()
+                for file_path in sorted(glob.glob(os.path.join(scan_data_dir, f"*{suffix}")))]
+
+    def set_sources(self, sources):
+        self.sources = sources
+        # identifies the content, not where the files are
+        content = json.dumps([[data_type, sha1] for data_type, _, _, _, sha1 in sources])
+        self.version = hashlib.sha1(content.encode()).hexdigest()[:12]
+
+    def __load_scan_data(self):
         scan_data_entries = []
-        scan_data_by_type = {
-            ScanDataType.TG_ID: [],
-            ScanDataType.TG_USER_NAME: [],
-            ScanDataType.TG_USERNAME: [],
-            ScanDataType.TG_KEYWORD: [],
-            ScanDataType.TG_URL: [],
-            ScanDataType.TG_IGNORED_ID: [],
-            ScanDataType.INSTAGRAM_USERNAME: [],
-            ScanDataType.INSTAGRAM_URL: [],
-            ScanDataType.INSTAGRAM_NAME: [],
-        }
+        scan_data_by_type = {data_type: [] for data_type in ScanDataType}
+        sources = []
 
-        for data_type, suffix in data_files.items():
-            pattern = os.path.join(scan_data_dir, f"*{suffix}")
-            for file_path in glob.glob(pattern):
-                with open(file_path, 'r') as file:
-                    for line in file:
-                        data = line.strip()
-                        if data:
-                            entry = ScanDataEntry(data, data_type)
-                            scan_data_entries.append(entry)
-                            scan_data_by_type[data_type].append(entry)
+        # the same entry listed in several files is kept once
+        seen = set()
+        for data_type, file_path in self.source_files():
+            with open(file_path, 'rb') as file:
+                stat = os.fstat(file.fileno())
+                content = file.read()
+            sources.append([data_type.name, file_path, stat.st_size, stat.st_mtime_ns, hashlib.sha1(content).hexdigest()])
+            for line in content.decode('utf-8').splitlines():
+                data = line.strip()
+                if data:
+                    entry = ScanDataEntry(data, data_type)
+                    if (data_type, entry.data) in seen:
+                        continue
+                    seen.add((data_type, entry.data))
+                    scan_data_entries.append(entry)
+                    scan_data_by_type[data_type].append(entry)
 
-        return scan_data_entries, scan_data_by_type
+        return scan_data_entries, scan_data_by_type, sources
 
     def load(self):
-        self.data, self.data_by_type = self.__load_scan_data()
+        self.data, self.data_by_type, sources = self.__load_scan_data()
+        self.set_sources(sources)
+        self.index = self.__build_index(self.data_by_type)
+        return self
+
+    def load_entries(self, entries: list[ScanDataEntry], data_by_type: dict[ScanDataType, list[ScanDataEntry]]):
+        """Uses already loaded entries, e.g. from a snapshot."""
+        self.data, self.data_by_type = entries, data_by_type
+        self.index = self.__build_index(self.data_by_type)
         return self
 
+    def __build_index(self, data_by_type):
+        index = ScanDataIndex(data_by_type)
+        if self.config.telegram.fuzzy_titles.enabled:
+            # while loading rather than on the first dialog check, which runs on the event loop
+            index.build_titles()
+        return index
+
+    def is_modified(self) -> bool:
+        """Checks the scan data files by size and mtime, new and removed files included."""
+        files = self.source_files()
+        if [(data_type.name, path) for data_type, path in files] != [(t, path) for t, path, *_ in self.sources]:
+            return True
+        for _, path, size, mtime_ns, _ in self.sources:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return True
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                return True
+        return False
+
+    def reload(self):
+        """Returns the next version of the scan data if its files changed, None otherwise.
+
+        Entries that are kept are shared with this version, the index and the matcher are updated with the added
+        and removed entries instead of being built again."""
+        if not self.is_modified():
+            return None
+        scan_data = ScanData(self.config)
+        data, data_by_type, sources = scan_data.__load_scan_data()
+        scan_data.set_sources(sources)
+        if scan_data.version == self.version:
+            # touched, not changed
+            self.sources = sources
+            return None
+
+        current = {(entry.data_type, entry.data): entry for entry in self.data}
+        loaded = set()
+        added = []
+        for i, entry in enumerate(data):
+            key = (entry.data_type, entry.data)
+            loaded.add(key)
+            if key in current:
+                data[i] = current[key]
+            else:
+                added.append(entry)
+        removed = [entry for key, entry in current.items() if key not in loaded]
+        scan_data.data = data
+        scan_data.data_by_type = {data_type: [] for data_type in ScanDataType}
+        for entry in data:
+            scan_data.data_by_type[entry.data_type].append(entry)
+        scan_data.index = self.index.updated(scan_data.data_by_type, added, removed)
+        if self.config.telegram.fuzzy_titles.enabled:
+            scan_data.index.build_titles()
+        if self.matcher is not None:
+            scan_data.matcher = self.matcher.updated(scan_data, added, removed)
+        scan_data.changes = (len(added), len(removed))
+        return scan_data
+
 
 if __name__ == "__main__":
     config, config_exists = load_config("config.yaml")
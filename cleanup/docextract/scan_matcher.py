@@ -0,0 +1,267 @@
+import mmap
+from array import array
+
+from cleanup.docextract.scan_data import ScanData, ScanDataEntry, ScanDataType
+
+# Order in which matched entries are reported, mirrors the order of checks in TelegramScanner.check_message_text
+MATCH_ORDER = [
+    ScanDataType.TG_USERNAME,
+    ScanDataType.TG_USER_NAME,
+    ScanDataType.INSTAGRAM_NAME,
+    ScanDataType.INSTAGRAM_USERNAME,
+    ScanDataType.TG_KEYWORD,
+    ScanDataType.TG_URL,
+]
+
+PATTERN_PREFIXES = {
+    ScanDataType.TG_USERNAME: ["@", "t.me/"],
+    ScanDataType.TG_USER_NAME: ["@", "t.me/"],
+    ScanDataType.INSTAGRAM_NAME: ["instagram.com/"],
+    ScanDataType.INSTAGRAM_USERNAME: ["instagram.com/"],
+    ScanDataType.TG_KEYWORD: [""],
+    ScanDataType.TG_URL: [""],
+}
+
+
+class AhoCorasick:
+    """Aho-Corasick automaton, finds all added patterns in a single pass over the text."""
+
+    def __init__(self):
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._out: list[tuple] = [()]
+        self._built = False
+
+    def __len__(self):
+        return len(self._goto)
+
+    def add(self, pattern: str, value):
+        if not pattern:
+            return
+        node = 0
+        for ch in pattern:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            node = nxt
+        self._out[node] = self._out[node] + (value,)
+        self._built = False
+
+    def build(self):
+        goto, fail, out = self._goto, self._fail, self._out
+        queue = list(goto[0].values())
+        for node in queue:
+            fail[node] = 0
+        i = 0
+        while i < len(queue):
+            node = queue[i]
+            i += 1
+            for ch, child in goto[node].items():
+                queue.append(child)
+                state = fail[node]
+                while state and ch not in goto[state]:
+                    state = fail[state]
+                fail[child] = goto[state].get(ch, 0)
+                if out[fail[child]]:
+                    out[child] = out[child] + out[fail[child]]
+        self._built = True
+        return self
+
+    def iter_matches(self, text: str):
+        if not self._built:
+            self.build()
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for ch in text:
+            nxt = goto[node].get(ch)
+            while nxt is None and node:
+                node = fail[node]
+                nxt = goto[node].get(ch)
+            node = nxt or 0
+            if out[node]:
+                yield from out[node]
+
+
+# arrays of CompiledAhoCorasick, in file order
+COMPILED_ARRAYS = ('node_edges', 'edge_chars', 'edge_targets', 'fail', 'out_offsets', 'out_values')
+
+
+class CompiledAhoCorasick:
+    """AhoCorasick automaton in flat uint32 arrays that can be written to a file and memory-mapped back
+    without rebuilding. Edges of node n are edge_chars/edge_targets[node_edges[n]:node_edges[n + 1]], sorted
+    by code point, its matches are out_values[out_offsets[n]:out_offsets[n + 1]].
+
+    Matching reads a node from the arrays the first time it is visited and keeps it as (edges dict, fail node,
+    matches), so it runs at the speed of AhoCorasick without loading the nodes no text reaches."""
+
+    def __init__(self, arrays, source=None):
+        self.arrays = arrays
+        # (path, {name: (offset, count)}) of a mapped file, lets workers map it again instead of copying
+        self.source = source
+        self.node_edges, self.edge_chars, self.edge_targets, self.fail, self.out_offsets, self.out_values = \
+            (arrays[name] for name in COMPILED_ARRAYS)
+        self._nodes: list[tuple | None] = [None] * len(self)
+
+    def __len__(self):
+        return len(self.node_edges) - 1
+
+    @classmethod
+    def from_automaton(cls, automaton: AhoCorasick):
+        if not automaton._built:
+            automaton.build()
+        arrays = {name: array('I') for name in COMPILED_ARRAYS}
+        arrays['node_edges'].append(0)
+        arrays['out_offsets'].append(0)
+        for goto, outputs in zip(automaton._goto, automaton._out):
+            for ch in sorted(goto):
+                arrays['edge_chars'].append(ord(ch))
+                arrays['edge_targets'].append(goto[ch])
+            arrays['node_edges'].append(len(arrays['edge_chars']))
+            arrays['out_values'].extend(outputs)
+            arrays['out_offsets'].append(len(arrays['out_values']))
+        arrays['fail'].extend(automaton._fail)
+        return cls(arrays)
+
+    @classmethod
+    def map_file(cls, path, sections):
+        """Maps arrays stored at {name: (offset, count)} of the file, read-only."""
+        with open(path, 'rb') as f:
+            mapped = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        arrays = {name: mapped[offset:offset + count * 4].cast('I') for name, (offset, count) in sections.items()}
+        return cls(arrays, source=(path, sections))
+
+    def __getstate__(self):
+        if self.source:
+            return {'source': self.source}
+        return {'arrays': self.arrays}
+
+    def __setstate__(self, state):
+        if 'source' in state:
+            self.__init__(type(self).map_file(*state['source']).arrays, state['source'])
+        else:
+            self.__init__(state['arrays'])
+
+    def _load_node(self, node):
+        lo, hi = self.node_edges[node], self.node_edges[node + 1]
+        start, end = self.out_offsets[node], self.out_offsets[node + 1]
+        state = (dict(zip(map(chr, self.edge_chars[lo:hi]), self.edge_targets[lo:hi].tolist())),
+                 self.fail[node], tuple(self.out_values[start:end]))
+        self._nodes[node] = state
+        return state
+
+    def iter_matches(self, text: str):
+        if not self._nodes:
+            return
+        nodes, load = self._nodes, self._load_node
+        root = state = nodes[0] or load(0)
+        for ch in text:
+            nxt = state[0].get(ch)
+            while nxt is None and state is not root:
+                fail = state[1]
+                state = nodes[fail] or load(fail)
+                nxt = state[0].get(ch)
+            if nxt is not None:
+                state = nodes[nxt] or load(nxt)
+                if state[2]:
+                    yield from state[2]
+
+
+# position of each type in MATCH_ORDER, orders matches of the base and the delta automatons together
+MATCH_RANK = {data_type: rank for rank, data_type in enumerate(MATCH_ORDER)}
+
+# a reloaded matcher is built again once its delta and removed entries exceed this share of the base entries
+REBUILD_RATIO = 0.1
+REBUILD_MIN = 1000
+
+
+class ScanDataMatcher:
+    """Compiled text matcher for message checks, built once from ScanData.
+
+    Reloaded scan data keeps the automaton of the version it was built for: added entries are matched by a small
+    delta automaton and removed ones are skipped, until the changes outgrow REBUILD_RATIO of the base."""
+
+    def __init__(self, scan_data: ScanData):
+        self.entries: list[ScanDataEntry] = []
+        self.automaton = AhoCorasick()
+        for data_type in MATCH_ORDER:
+            for entry in scan_data.data_by_type.get(data_type, []):
+                ordinal = len(self.entries)
+                self.entries.append(entry)
+                for prefix in PATTERN_PREFIXES[data_type]:
+                    self.automaton.add(prefix + entry.data, ordinal)
+        self.automaton.build()
+        self.__init_delta()
+
+    def __init_delta(self):
+        self.delta_entries: list[ScanDataEntry] = []
+        self.delta = None
+        self.removed: frozenset[int] = frozenset()
+        # {(data_type, data): ordinal} of the base entries, shared by the reloaded versions
+        self.ordinals = None
+
+    @classmethod
+    def from_compiled(cls, entries: list[ScanDataEntry], automaton: CompiledAhoCorasick):
+        """Matcher over a compiled automaton whose values are positions in entries."""
+        matcher = cls.__new__(cls)
+        matcher.entries = entries
+        matcher.automaton = automaton
+        matcher.__init_delta()
+        return matcher
+
+    def updated(self, scan_data: ScanData, added, removed) -> 'ScanDataMatcher':
+        """Matcher for scan_data, the next version of the data with added and removed entries."""
+        if self.ordinals is None:
+            self.ordinals = {(entry.data_type, entry.data): i for i, entry in enumerate(self.entries)}
+        removed_keys = {(entry.data_type, entry.data) for entry in removed}
+        delta_entries = [entry for entry in self.delta_entries if (entry.data_type, entry.data) not in removed_keys]
+        delta_entries += sorted((entry for entry in added if entry.data_type in MATCH_RANK),
+                                key=lambda entry: MATCH_RANK[entry.data_type])
+        removed_ordinals = self.removed.union(self.ordinals[key] for key in removed_keys if key in self.ordinals)
+        if len(delta_entries) + len(removed_ordinals) > max(REBUILD_MIN, len(self.entries) * REBUILD_RATIO):
+            return ScanDataMatcher(scan_data)
+
+        matcher = ScanDataMatcher.from_compiled(self.entries, self.automaton)
+        matcher.ordinals = self.ordinals
+        matcher.removed = frozenset(removed_ordinals)
+        matcher.delta_entries = delta_entries
+        if delta_entries:
+            matcher.delta = AhoCorasick()
+            for ordinal, entry in enumerate(delta_entries):
+                for prefix in PATTERN_PREFIXES[entry.data_type]:
+                    matcher.delta.add(prefix + entry.data, ordinal)
+            matcher.delta.build()
+        return matcher
+
+    def iter_entries(self):
+        """Yields the entries the matcher finds, in check order."""
+        if not self.delta_entries:
+            yield from (entry for i, entry in enumerate(self.entries) if i not in self.removed)
+            return
+        entries = [entry for i, entry in enumerate(self.entries) if i not in self.removed] + self.delta_entries
+        yield from sorted(entries, key=lambda entry: MATCH_RANK[entry.data_type])
+
+    def patterns(self):
+        """Yields (pattern, entry) pairs the matcher was built from."""
+        for entry in self.iter_entries():
+            for prefix in PATTERN_PREFIXES[entry.data_type]:
+                yield prefix + entry.data, entry
+
+    def find(self, text: str) -> list[ScanDataEntry]:
+        """Returns every entry found in text, each once, in check order."""
+        if not text:
+            return []
+        ordinals = set(self.automaton.iter_matches(text))
+        if self.removed:
+            ordinals -= self.removed
+        found = [self.entries[i] for i in sorted(ordinals)]
+        if self.delta is not None:
+            delta_ordinals = set(self.delta.iter_matches(text))
+            if delta_ordinals:
+                found += [self.delta_entries[i] for i in sorted(delta_ordinals)]
+                # stable, base entries stay ahead of delta entries of the same type
+                found.sort(key=lambda entry: MATCH_RANK[entry.data_type])
+        return found
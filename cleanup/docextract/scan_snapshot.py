@@ -0,0 +1,174 @@
+import hashlib
+import json
+import logging
+import os
+import struct
+import sys
+from array import array
+
+from cleanup.config.scan_config import Config
+from cleanup.docextract.scan_data import ScanData, ScanDataEntry, ScanDataType
+from cleanup.docextract.scan_matcher import (COMPILED_ARRAYS, MATCH_ORDER, PATTERN_PREFIXES, CompiledAhoCorasick,
+                                             ScanDataMatcher)
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b'CLNSCAN\0'
+SNAPSHOT_VERSION = 1
+# magic, version, header offset, header length
+SNAPSHOT_PREFIX = struct.Struct('<8sIQQ')
+
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def snapshot_key():
+    """Everything besides the sources the compiled data depends on."""
+    return {
+        'version': SNAPSHOT_VERSION,
+        'byteorder': sys.byteorder,
+        'match_order': [data_type.name for data_type in MATCH_ORDER],
+        'prefixes': {data_type.name: prefixes for data_type, prefixes in PATTERN_PREFIXES.items()},
+    }
+
+
+def is_current(header, sources):
+    """Checks the snapshot was built from the sources as they are now. Files whose size or mtime changed are
+    compared by content, so touching a file doesn't force a rebuild."""
+    if header.get('key') != snapshot_key():
+        return False
+    stored = header.get('sources', [])
+    if [(data_type, path) for data_type, path, *_ in stored] != [(t.name, path) for t, path in sources]:
+        return False
+    for _, path, size, mtime_ns, sha1 in stored:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns) and (stat.st_size != size or file_sha1(path) != sha1):
+            return False
+    return True
+
+
+def write_snapshot(path, scan_data: ScanData, matcher: ScanDataMatcher):
+    """Writes entries and the compiled matcher of scan_data, atomically."""
+    entry_types = array('I', (entry.data_type.value for entry in scan_data.data))
+    entry_offsets = array('I', [0])
+    for entry in scan_data.data:
+        entry_offsets.append(entry_offsets[-1] + len(entry.data))
+    positions = {id(entry): i for i, entry in enumerate(scan_data.data)}
+    matcher_entries = array('I', (positions[id(entry)] for entry in matcher.entries))
+    automaton = matcher.automaton if isinstance(matcher.automaton, CompiledAhoCorasick) \
+        else CompiledAhoCorasick.from_automaton(matcher.automaton)
+
+    sections = {'entry_types': entry_types, 'entry_offsets': entry_offsets, 'matcher_entries': matcher_entries}
+    sections.update(automaton.arrays)
+    text = ''.join(entry.data for entry in scan_data.data).encode('utf-8')
+
+    temp_path = f"{path}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(b'\0' * SNAPSHOT_PREFIX.size)
+            layout = {}
+            for name, values in sections.items():
+                # arrays are aligned so they can be cast from the mapped file
+                f.write(b'\0' * (-f.tell() % 8))
+                layout[name] = [f.tell(), len(values)]
+                f.write(memoryview(values).cast('B'))
+            layout['text'] = [f.tell(), len(text)]
+            f.write(text)
+            header = json.dumps({'key': snapshot_key(), 'sources': scan_data.sources,
+                                 'entry_count': len(scan_data.data), 'sections': layout}).encode('utf-8')
+            header_offset = f.tell()
+            f.write(header)
+            f.seek(0)
+            f.write(SNAPSHOT_PREFIX.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, header_offset, len(header)))
+        os.replace(temp_path, path)
+    except OSError:
+        # a full disk leaves a partial file behind
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        magic, version, header_offset, header_length = SNAPSHOT_PREFIX.unpack(f.read(SNAPSHOT_PREFIX.size))
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            return None
+        f.seek(header_offset)
+        return json.loads(f.read(header_length))
+
+
+def read_snapshot(path, header, config: Config) -> ScanData:
+    sections = header['sections']
+
+    def read_array(f, name):
+        offset, count = sections[name]
+        f.seek(offset)
+        values = array('I')
+        values.frombytes(f.read(count * values.itemsize))
+        return values
+
+    with open(path, 'rb') as f:
+        entry_types = read_array(f, 'entry_types')
+        entry_offsets = read_array(f, 'entry_offsets')
+        matcher_entries = read_array(f, 'matcher_entries')
+        offset, length = sections['text']
+        f.seek(offset)
+        text = f.read(length).decode('utf-8')
+
+    # entries are stored normalized, they skip ScanDataEntry.__init__
+    data_types = {data_type.value: data_type for data_type in ScanDataType}
+    by_value = {value: [] for value in data_types}
+    entries = []
+    for i, type_value in enumerate(entry_types):
+        entry = ScanDataEntry.__new__(ScanDataEntry)
+        entry.data = text[entry_offsets[i]:entry_offsets[i + 1]]
+        entry.data_type = data_types[type_value]
+        entries.append(entry)
+        by_value[type_value].append(entry)
+
+    data_by_type = {data_types[value]: type_entries for value, type_entries in by_value.items()}
+    scan_data = ScanData(config).load_entries(entries, data_by_type)
+    scan_data.set_sources(header['sources'])
+    automaton = CompiledAhoCorasick.map_file(path, {name: tuple(sections[name]) for name in COMPILED_ARRAYS})
+    scan_data.matcher = ScanDataMatcher.from_compiled([entries[i] for i in matcher_entries], automaton)
+    return scan_data
+
+
+def load_scan_data(config: Config) -> ScanData:
+    """Loads scan data with a compiled matcher, from the snapshot in the cache dir while the scan data files
+    are unchanged. Otherwise the files are loaded and the snapshot is rebuilt.
+
+    Only the automaton is mapped from the snapshot; the entries are read from it but their lookup index is
+    built again at every start. A snapshot that can't be written leaves the scan on the in-memory matcher."""
+    if not config.paths.scan_data_snapshot:
+        return ScanData(config).load()
+    path = os.path.join(config.paths.cache_dir, config.paths.scan_data_snapshot)
+    sources = ScanData(config).source_files()
+    if os.path.exists(path):
+        try:
+            header = read_header(path)
+            if header is not None and is_current(header, sources):
+                return read_snapshot(path, header, config)
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            logger.warning("Can't read scan data snapshot %s: %s", path, e)
+
+    scan_data = ScanData(config).load()
+    scan_data.matcher = ScanDataMatcher(scan_data)
+    if scan_data.data:
+        try:
+            os.makedirs(config.paths.cache_dir, exist_ok=True)
+            write_snapshot(path, scan_data, scan_data.matcher)
+            logger.info("Scan data snapshot %s written, %s entries", path, len(scan_data.data))
+        except OSError as e:
+            logger.warning("Can't write scan data snapshot %s, using the matcher built in memory: %s", path, e)
+    return scan_data
@@ -0,0 +1,247 @@
+import re
+import unicodedata
+from array import array
+
+# Latin letters that look like Cyrillic ones, lowercase or uppercase, after casefold
+LATIN_TO_CYRILLIC = {
+    'a': 'а', 'b': 'в', 'c': 'с', 'e': 'е', 'h': 'н', 'i': 'і', 'j': 'ј', 'k': 'к', 'm': 'м', 'o': 'о', 'p': 'р',
+    's': 'ѕ', 't': 'т', 'x': 'х', 'y': 'у',
+}
+CYRILLIC_TO_LATIN = {cyrillic: latin for latin, cyrillic in LATIN_TO_CYRILLIC.items()}
+
+TRANSLITERATION = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'ґ': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'є': 'ye', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'і': 'i', 'ї': 'yi', 'й': 'y', 'ј': 'j', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p',
+    'р': 'r', 'с': 's', 'ѕ': 's', 'т': 't', 'у': 'u', 'ў': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh',
+    'щ': 'sch', 'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+}
+
+# quotes, emoji and other symbols separate words like spaces
+NON_WORD = re.compile(r'[\W_]+')
+
+# one edit is allowed per this many letters of the title words a name doesn't share, up to max_distance
+CHARS_PER_EDIT = 5
+# padded trigrams one edit can change: a swap of adjacent letters changes the 4 covering either of them
+GRAMS_PER_EDIT = 4
+# postings read besides the 4k + 1 needed to find every title within k edits
+FILTER_GRAMS = 3
+# an updated matcher is compacted once its removed titles exceed this share of the titles
+REBUILD_RATIO = 0.1
+REBUILD_MIN = 1000
+
+
+def is_cyrillic(ch):
+    return 'Ѐ' <= ch <= 'ӿ'
+
+
+def fold_confusables(word):
+    """Writes look-alike letters of a mixed Cyrillic/Latin word in the script of the word."""
+    cyrillic = sum(1 for ch in word if is_cyrillic(ch) and ch not in CYRILLIC_TO_LATIN)
+    latin = sum(1 for ch in word if 'a' <= ch <= 'z' and ch not in LATIN_TO_CYRILLIC)
+    if not cyrillic and not latin:
+        # only look-alikes, the script most of them are written in decides
+        cyrillic = sum(1 for ch in word if is_cyrillic(ch))
+        latin = sum(1 for ch in word if 'a' <= ch <= 'z')
+    mapping = LATIN_TO_CYRILLIC if cyrillic >= latin else CYRILLIC_TO_LATIN
+    return ''.join(mapping.get(ch, ch) for ch in word)
+
+
+def title_words(title: str) -> list[tuple[str, int]]:
+    """Normalized words of a title with the number of letters each has in the title, before transliteration."""
+    text = unicodedata.normalize('NFKC', title).casefold()
+    words = []
+    for word in NON_WORD.split(text):
+        if not word:
+            continue
+        normalized = ''.join(TRANSLITERATION.get(ch, ch) for ch in fold_confusables(word))
+        normalized = ''.join(ch for ch in unicodedata.normalize('NFKD', normalized) if not unicodedata.combining(ch))
+        if normalized:
+            words.append((normalized, len(word)))
+    return words
+
+
+def normalize_title(title: str) -> str:
+    """Reduces a title to lowercase Latin words: compatibility forms, quotes, emoji and punctuation, look-alike
+    letters, Cyrillic and diacritics don't affect the result."""
+    return ' '.join(word for word, _ in title_words(title))
+
+
+def letter_count(words) -> int:
+    return sum(letters for _, letters in words) + len(words) - 1 if words else 0
+
+
+def allowed_edits(words, name: str, max_edits: int) -> int:
+    """Edits allowed between the title words and a normalized name: one per CHARS_PER_EDIT letters of the words
+    the name doesn't share at its start or end. A common word like a city name doesn't make two different short
+    names similar, and transliteration doesn't give Cyrillic titles more edits than their letters."""
+    name_words = name.split(' ')
+    shared = min(len(words), len(name_words))
+    start = 0
+    while start < shared and words[start][0] == name_words[start]:
+        start += 1
+    end = 0
+    while end < shared - start and words[-1 - end][0] == name_words[-1 - end]:
+        end += 1
+    return min(max_edits, letter_count(words[start:len(words) - end]) // CHARS_PER_EDIT)
+
+
+def trigrams(text: str) -> set[str]:
+    padded = f"  {text}  "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def bounded_distance(a: str, b: str, limit: int) -> int:
+    """Edit distance of a and b counting a swap of adjacent letters as one edit, limit + 1 if it is above limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before_previous = None
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        row_min = i
+        for j, cb in enumerate(b, 1):
+            distance = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb))
+            if before_previous is not None and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                distance = min(distance, before_previous[j - 2] + 1)
+            current.append(distance)
+            if distance < row_min:
+                row_min = distance
+        if row_min > limit:
+            return limit + 1
+        before_previous, previous = previous, current
+    return min(previous[-1], limit + 1)
+
+
+class TitleMatcher:
+    """Finds the scan data entry whose name is closest to a chat title within a few edits of the normalized forms.
+
+    Candidates come from a trigram index: a title within k edits of the query shares all but 4k of its trigrams,
+    so it is in all but 4k of the postings of any of them. Only the rarest postings are read and the candidates
+    are verified by edit distance, the lookup doesn't go over all names.
+
+    Updated versions share entries, titles and postings, which only grow: a version sees the positions below its
+    size that it hasn't removed, so the previous version keeps working while the next one is in use. Versions
+    are derived one after another, like scan data reloads."""
+
+    def __init__(self, entries=()):
+        self.entries = []
+        self.titles: list[str] = []
+        self.postings: dict[str, array] = {}
+        self.size = 0
+        self.exact: dict[str, int] = {}
+        self.removed: set[int] = set()
+        # entries with the same normalized title as an indexed one, they take its place when it is removed
+        self.shadowed: dict[str, tuple] = {}
+        for entry in entries:
+            self.add(entry)
+
+    def __len__(self):
+        return len(self.exact)
+
+    def __append(self, entry, title):
+        position = len(self.titles)
+        self.exact[title] = position
+        self.titles.append(title)
+        self.entries.append(entry)
+        for gram in trigrams(title):
+            self.postings.setdefault(gram, array('I')).append(position)
+        self.size = position + 1
+
+    def add(self, entry):
+        title = normalize_title(entry.data)
+        if not title:
+            return
+        if title in self.exact:
+            self.shadowed[title] = self.shadowed.get(title, ()) + (entry,)
+            return
+        self.__append(entry, title)
+
+    def remove(self, entry):
+        title = normalize_title(entry.data)
+        position = self.exact.get(title)
+        if position is None:
+            return
+        shadowed = self.shadowed.pop(title, ())
+        if self.entries[position] is not entry:
+            shadowed = tuple(other for other in shadowed if other is not entry)
+            if shadowed:
+                self.shadowed[title] = shadowed
+            return
+        del self.exact[title]
+        self.removed.add(position)
+        if shadowed:
+            self.__append(shadowed[0], title)
+            if len(shadowed) > 1:
+                self.shadowed[title] = shadowed[1:]
+
+    def updated(self, added, removed) -> 'TitleMatcher':
+        """Next version with entries added and removed, only their names are normalized. Compacted into new
+        postings once removed titles outgrow REBUILD_RATIO."""
+        matcher = TitleMatcher()
+        matcher.entries, matcher.titles, matcher.postings = self.entries, self.titles, self.postings
+        matcher.size = self.size
+        matcher.exact, matcher.removed, matcher.shadowed = dict(self.exact), set(self.removed), dict(self.shadowed)
+        for entry in removed:
+            matcher.remove(entry)
+        for entry in added:
+            matcher.add(entry)
+        if len(matcher.removed) > max(REBUILD_MIN, matcher.size * REBUILD_RATIO):
+            return matcher.compacted()
+        return matcher
+
+    def compacted(self) -> 'TitleMatcher':
+        """Copy without the removed titles, from the titles already normalized."""
+        matcher = TitleMatcher()
+        for position in sorted(self.exact.values()):
+            matcher.__append(self.entries[position], self.titles[position])
+        matcher.shadowed = dict(self.shadowed)
+        return matcher
+
+    def candidates(self, query: str, max_edits: int) -> list[int]:
+        grams = trigrams(query)
+        missing = GRAMS_PER_EDIT * max_edits
+        if len(grams) <= missing:
+            # too short to filter by trigrams, left to the exact lookup
+            return []
+        # a title has to be in all but 4k of the postings read, reading a few more than 4k + 1 of them filters
+        # out most titles sharing only common trigrams
+        read = min(len(grams), missing + 1 + FILTER_GRAMS)
+        postings = sorted((self.postings.get(gram, ()) for gram in grams), key=len)[:read]
+        counts = {}
+        for positions in postings:
+            for position in positions:
+                counts[position] = counts.get(position, 0) + 1
+        required = read - missing
+        size, removed = self.size, self.removed
+        return sorted(position for position, count in counts.items()
+                      if count >= required and position < size and position not in removed)
+
+    def find(self, title: str, max_distance: int = 2):
+        """Closest entry within max_distance edits of the normalized title, fewer for short titles and for the
+        words a name shares with it, see allowed_edits. None if there is none."""
+        if not title:
+            return None
+        words = title_words(title)
+        query = ' '.join(word for word, _ in words)
+        if not query:
+            return None
+        position = self.exact.get(query)
+        if position is not None:
+            return self.entries[position]
+        max_edits = min(max_distance, letter_count(words) // CHARS_PER_EDIT)
+        if max_edits <= 0:
+            return None
+
+        # ties go to the entry listed first
+        best, best_distance = None, max_edits + 1
+        for candidate in self.candidates(query, max_edits):
+            name = self.titles[candidate]
+            limit = min(allowed_edits(words, name, max_edits), best_distance - 1)
+            if limit <= 0:
+                continue
+            distance = bounded_distance(query, name, limit)
+            if distance <= limit:
+                best, best_distance = candidate, distance
+                if distance == 1:
+                    break
+        return self.entries[best] if best is not None else None
@@ -0,0 +1,37 @@
+import asyncio
+import time
+
+from telethon.errors import FloodWaitError
+
+
+class FloodWaitLimiter:
+    """Shared by dialog workers: bounds in-flight requests and pauses every worker when Telegram asks to wait."""
+
+    def __init__(self, max_concurrent=1, max_retries=5):
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._resume_at = 0.0
+
+    def pause(self, seconds):
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+    async def wait(self):
+        delay = self._resume_at - time.monotonic()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self._resume_at - time.monotonic()
+
+    async def call(self, request, *args, **kwargs):
+        """Awaits request(*args, **kwargs), retrying it after FloodWait."""
+        attempt = 0
+        while True:
+            await self.wait()
+            async with self._semaphore:
+                try:
+                    return await request(*args, **kwargs)
+                except FloodWaitError as e:
+                    attempt += 1
+                    if attempt > self.max_retries:
+                        raise
+                    print(f"FloodWait for {e.seconds}s, pausing all workers")
+                    self.pause(e.seconds)
@@ -1,18 +1,34 @@
+import asyncio
 import logging
+import os
+from contextlib import AsyncExitStack
 
 import pytz
+from telethon.errors import FloodWaitError, TakeoutInitDelayError, TakeoutInvalidError
 from telethon.tl.custom import Forward
 from telethon.tl.functions.channels import GetFullChannelRequest
-from telethon.tl.types import User, Chat, Channel
+from telethon.tl.types import User, Chat, Channel, InputMessagesFilterUrl
 
-from cleanup.config.scan_config import Config
+from cleanup.chat_cache import ChatCache
+from cleanup.config.scan_config import Config, SEARCH_MODE_FULL, SEARCH_MODE_SEARCH, MODE_ONLINE, MODE_OFFLINE, \
+    MODE_APPLY_PLAN, CACHE_FORMAT_FULL
+from cleanup.delete_queue import DeleteQueue
 from cleanup.docextract.scan_data import ScanDataType, ScanData
+from cleanup.docextract.scan_matcher import ScanDataMatcher
+from cleanup.flood_wait import FloodWaitLimiter
 from cleanup.login_module import get_phone_number, login, create_client
-from cleanup.storage.pg import PostgresStorage
+from cleanup.message_checks import text_check_for, text_checks_enabled
+from cleanup.offline_scan import OfflineScanner
+from cleanup.storage.async_storage import AsyncStorage
+from cleanup.storage.compact import compact_message, compact_peer, compact_full_chat, compress_json
+from cleanup.storage.factory import create_storage
 from cleanup.utils import first_not_null, getattrd
 
 logger = logging.getLogger(__name__)
 
+# resume checkpoints are written every N processed messages of a dialog
+CHECKPOINT_EVERY = 500
+
 
 class TelegramScanner:
     def __init__(self, config: Config, scan_data: ScanData):
@@ -24,8 +40,40 @@ class TelegramScanner:
         self.config = config
         self.telegram_config = config.telegram
         self.scan_data = scan_data
-        self.cache_storage = PostgresStorage() if self.telegram_config.cache_messages or self.telegram_config.cache_peers else None
-        self.ignored_ids = [int(d.data) for d in scan_data.data_by_type[ScanDataType.TG_IGNORED_ID]]
+        self.storage = create_storage(config.storage) if self.telegram_config.cache_messages or self.telegram_config.cache_peers else None
+        self.cache_storage = AsyncStorage(self.storage) if self.storage else None
+        if scan_data.matcher is None:
+            scan_data.matcher = ScanDataMatcher(scan_data)
+        self.limiter = FloodWaitLimiter(max_concurrent=max(1, self.telegram_config.dialog_workers))
+        self.dialogs_done = 0
+        self.delete_queues: dict[int, DeleteQueue] = {}
+        self.fetch_client = None
+        self.chat_cache = None
+        # (matcher, terms) of the last scan data version searched for
+        self.search_terms = None
+        self.config_hash = self.telegram_config.scan_fingerprint()
+        if self.telegram_config.resume and not self.telegram_config.cache_peers:
+            logger.warning("Resume requires cache_peers, all dialogs will be scanned from the beginning.")
+
+    @property
+    def matcher(self) -> ScanDataMatcher:
+        return self.scan_data.matcher
+
+    async def __watch_scan_data(self):
+        """Switches to the next scan data version when its files change, checks read self.scan_data once per
+        message so every message is checked against a single version."""
+        interval = self.config.paths.scan_data_reload_interval
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                scan_data = await asyncio.to_thread(self.scan_data.reload)
+            except (OSError, ValueError) as e:
+                logger.warning("Can't reload scan data: %s", e)
+                continue
+            if scan_data is not None:
+                added, removed = scan_data.changes
+                print(f"Scan data reloaded, version {scan_data.version}: {added} entries added, {removed} removed")
+                self.scan_data = scan_data
 
     @staticmethod
     def get_peer_type(chat):
@@ -39,179 +87,340 @@ class TelegramScanner:
 
     def __should_skip_dialog(self, dialog, from_date=None, to_date=None):
         dialog_date = dialog.date.replace(tzinfo=self.utc)
-        return dialog.id in self.ignored_ids or dialog_date < from_date or dialog_date > to_date
+        return self.scan_data.index.is_ignored(dialog.id) or dialog_date < from_date or dialog_date > to_date
 
     async def __clean_up_telegram(self, client):
         current_user = await client.get_me()
+        workers = max(1, self.telegram_config.dialog_workers)
+        dialogs = client.iter_dialogs(limit=None, offset_date=self.telegram_config.to_date)
+        queue = asyncio.Queue(maxsize=workers * 2)
+
+        async def worker():
+            # a failed dialog is logged and the scan goes on, with one worker as with many
+            while True:
+                dialog = await queue.get()
+                if dialog is None:
+                    return
+                try:
+                    await self.__process_dialog(client, dialog, current_user)
+                except Exception:
+                    logger.exception("Failed processing dialog %s", dialog.id)
+
+        tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+        async for dialog in dialogs:
+            await queue.put(dialog)
+        for _ in tasks:
+            await queue.put(None)
+        await asyncio.gather(*tasks)
+
+    async def __process_dialog(self, client, dialog, current_user):
+        attempt = 0
+        retry = False
+        while True:
+            try:
+                return await self.__clean_up_dialog(client, dialog, current_user, retry=retry)
+            except FloodWaitError as e:
+                attempt += 1
+                if attempt > self.limiter.max_retries:
+                    raise
+                print(f"FloodWait for {e.seconds}s while processing dialog {dialog.id}, retrying")
+                self.limiter.pause(e.seconds)
+                await self.limiter.wait()
+            except TakeoutInvalidError:
+                if self.fetch_client is client:
+                    raise
+                print(f"Takeout session was invalidated while processing dialog {dialog.id}, "
+                      f"fetching messages with the normal client")
+                self.fetch_client = client
+            retry = True
+
+    async def __clean_up_dialog(self, client, dialog, current_user, retry=False):
+        """Scans the dialog. A retry continues from the dialog checkpoint, like resume does."""
         current_user_id = getattr(current_user, 'id')
-
-        async for dialog in client.iter_dialogs(limit=None, offset_date=self.telegram_config.to_date):
-            dialog_id = dialog.id
-
-            if self.__should_skip_dialog(dialog, self.telegram_config.from_date, self.telegram_config.to_date):
-                continue
-
-            if self.telegram_config.cache_peers:
-                self.cache_storage.store_user_dialog(dialog_id, current_user_id)
-
-            chat = await client.get_entity(dialog.id)
-            dialog_name = first_not_null(getattrd(dialog, 'title'), getattrd(dialog, 'name'), self.get_chat_title(chat),
-                                         dialog.id)
-
-            print(dialog_name, dialog_id, chat.__class__.__name__)
-            chat_id = dialog_id
-            chat_username = getattr(chat, 'username', 'unknown')
-
-            if isinstance(chat, User) and not self.telegram_config.dialogs.users.enabled:
-                print(f"Skipping user {dialog_name} (ID {dialog_id})")
-                continue
-            if isinstance(chat, Chat) and not self.telegram_config.dialogs.chats.enabled:
-                print(f"Skipping chat {dialog_name} (ID {dialog_id})")
-                continue
-            if isinstance(chat, Channel) and not self.telegram_config.dialogs.channels.enabled:
-                print(f"Skipping channel {dialog_name} (ID {dialog_id})")
-                continue
-
-            if self.telegram_config.dialogs.checks.enabled:
-                for material in self.scan_data.data:
-                    if material.data_type.to_str() == ScanDataType.TG_ID.to_str():
-                        idd = int(material.data)
-                        if chat_id == idd or chat_id == -idd or -idd == 1000000000000 - chat_id:
-                            print(
-                                f"------------------------------  Found dialog check violation: {dialog_name} (ID {dialog_id}) ------------------------------ ")
-                            continue
-                    elif material.data_type.to_str() == ScanDataType.TG_USERNAME.to_str():
-                        username = material.data
-                        if chat_username == username:
-                            print(
-                                f"------------------------------  Found dialog check violation: {dialog_name} (ID {dialog_id}) ------------------------------ ")
-                            continue
-                    elif material.data_type.to_str() == ScanDataType.TG_USER_NAME.to_str():
-                        name = material.data
-                        if dialog_name == name:
-                            print(
-                                f"------------------------------  Found dialog check violation: {dialog_name} (ID {dialog_id}) ------------------------------ ")
-                            continue
-
-            if self.telegram_config.cache_peers:
-                self.cache_storage.store_peer([{
-                    'id': dialog.id,
-                    'title': dialog_name,
-                    'username': chat_username,
-                    'peer_type': self.get_peer_type(chat),
-                    'users_count': 0,
-                    'data': chat.to_json(ensure_ascii=False)
-                }])
-
-            if isinstance(chat, User):
-                if not self.telegram_config.dialogs.users.enabled:
-                    continue
-                print(f"Starting processing chat with user {dialog_name} (ID {dialog_id})")
-                await self.clean_chat(chat, client, current_user_id, dialog_id, dialog_name)
-                if self.telegram_config.cache_peers:
-                    self.cache_storage.mark_dialog_processed(dialog_id, current_user_id)
-            elif isinstance(chat, Chat):
-                if not self.telegram_config.dialogs.chats.enabled:
-                    continue
-                print(f"Starting processing chat {dialog_name} (ID {dialog_id})")
-                await self.clean_chat(chat, client, current_user_id, dialog_id, dialog_name)
-                if self.telegram_config.cache_peers:
-                    self.cache_storage.mark_dialog_processed(dialog_id, current_user_id)
-            elif isinstance(chat, Channel):
-                if not self.telegram_config.dialogs.chats.enabled:
-                    continue
-                if getattrd(chat, 'broadcast'):
-                    print(f"Skipping broadcast channel {dialog_name} (ID {dialog_id})")
-                    continue
-
-                channel_full_info = await client(GetFullChannelRequest(chat))
-                participants_count = getattrd(channel_full_info, 'full_chat.participants_count')
-                if self.telegram_config.cache_peers:
-                    self.cache_storage.store_full_chat_data(dialog_id, channel_full_info.to_json(ensure_ascii=False))
-                    self.cache_storage.store_users_count(dialog_id, participants_count)
-                filter_user = None
-                if participants_count is not None and participants_count > self.telegram_config.dialogs.channels.self_only_after_users_count:
-                    filter_user = current_user
+        dialog_id = dialog.id
+
+        if self.__should_skip_dialog(dialog, self.telegram_config.from_date, self.telegram_config.to_date):
+            return
+
+        checkpoint = None
+        scanned_message_id = scanned_top_message = None
+        if self.telegram_config.cache_peers:
+            processed, last_message_id, scanned_message_id, scanned_top_message = \
+                await self.cache_storage.store_user_dialog(dialog_id, current_user_id, self.config_hash,
+                                                           self.telegram_config.from_date, self.telegram_config.to_date)
+            if self.telegram_config.resume and processed:
+                print(f"Skipping already processed dialog {dialog_id}")
+                return
+            if self.telegram_config.resume or retry:
+                checkpoint = last_message_id
+
+        # get_dialogs already loaded the entity
+        chat = dialog.entity
+        if chat is None:
+            chat = await self.limiter.call(client.get_entity, dialog.id)
+        self.chat_cache.put(dialog.id, chat)
+        dialog_name = first_not_null(getattrd(dialog, 'title'), getattrd(dialog, 'name'), self.get_chat_title(chat),
+                                     dialog.id)
+
+        print(dialog_name, dialog_id, chat.__class__.__name__)
+        chat_id = dialog_id
+        chat_username = getattr(chat, 'username', None)
+
+        if isinstance(chat, User) and not self.telegram_config.dialogs.users.enabled:
+            print(f"Skipping user {dialog_name} (ID {dialog_id})")
+            return
+        if isinstance(chat, Chat) and not self.telegram_config.dialogs.chats.enabled:
+            print(f"Skipping chat {dialog_name} (ID {dialog_id})")
+            return
+        if isinstance(chat, Channel) and not self.telegram_config.dialogs.channels.enabled:
+            print(f"Skipping channel {dialog_name} (ID {dialog_id})")
+            return
+
+        if self.telegram_config.dialogs.checks.enabled:
+            index = self.scan_data.index
+            material = index.find_id(chat_id) or index.find_username(chat_username) or index.find_name(dialog_name) \
+                or self.__find_similar_name(index, dialog_name)
+            if material:
                 print(
-                    f"Starting processing channel {dialog_name} (ID {dialog_id}), participants count: {participants_count}")
-                await self.clean_chat(chat, client, current_user_id, dialog_id, dialog_name,
-                                      from_user=filter_user)
-                if self.telegram_config.cache_peers:
-                    self.cache_storage.mark_dialog_processed(dialog_id, current_user_id)
+                    f"------------------------------  Found dialog check violation: {dialog_name} (ID {dialog_id}) ------------------------------ ")
+
+        # stored in one upsert together with the channel full info
+        peer = None
+        if self.telegram_config.cache_peers:
+            data, data_raw = self.__cache_json(chat, compact_peer)
+            peer = {
+                'id': dialog.id,
+                'title': dialog_name,
+                'username': chat_username,
+                'peer_type': self.get_peer_type(chat),
+                'data': data,
+                'data_raw': data_raw,
+            }
+
+        top_message = getattrd(dialog, 'dialog.top_message')
+        if self.telegram_config.incremental and self.telegram_config.cache_peers:
+            if scanned_top_message and scanned_top_message == top_message:
+                print(f"Skipping dialog {dialog_name} (ID {dialog_id}), no new messages since the last scan")
+                await self.cache_storage.store_peer([peer])
+                return
+            if scanned_message_id and (checkpoint is None or scanned_message_id > checkpoint):
+                checkpoint = scanned_message_id
+
+        filter_user = None
+        if isinstance(chat, User):
+            if not self.telegram_config.dialogs.users.enabled:
+                return
+            print(f"Starting processing chat with user {dialog_name} (ID {dialog_id})")
+        elif isinstance(chat, Chat):
+            if not self.telegram_config.dialogs.chats.enabled:
+                return
+            print(f"Starting processing chat {dialog_name} (ID {dialog_id})")
+        elif isinstance(chat, Channel):
+            if not self.telegram_config.dialogs.chats.enabled:
+                return
+            if getattrd(chat, 'broadcast'):
+                print(f"Skipping broadcast channel {dialog_name} (ID {dialog_id})")
+                if peer:
+                    await self.cache_storage.store_peer([peer])
+                return
+
+            channel_full_info = await self.limiter.call(client, GetFullChannelRequest(chat))
+            participants_count = getattrd(channel_full_info, 'full_chat.participants_count')
+            if peer:
+                peer['full_chat_data'], peer['full_chat_data_raw'] = \
+                    self.__cache_json(channel_full_info, compact_full_chat)
+                peer['users_count'] = participants_count
+            if participants_count is not None and participants_count > self.telegram_config.dialogs.channels.self_only_after_users_count:
+                filter_user = current_user
+            print(
+                f"Starting processing channel {dialog_name} (ID {dialog_id}), participants count: {participants_count}")
+        else:
+            return
+        if peer:
+            await self.cache_storage.store_peer([peer])
+
+        if await self.__should_search(chat, client, from_user=filter_user):
+            await self.clean_chat_by_search(chat, client, dialog_name, from_user=filter_user, min_id=checkpoint)
+            # the search skips messages after to_date, it covered the dialog only when the top message isn't newer
+            reached_top = dialog.date.replace(tzinfo=self.utc) <= self.telegram_config.to_date
+            last_message_id = top_message if reached_top else None
+        else:
+            last_message_id, reached_top = await self.clean_chat(chat, client, current_user_id, dialog_id,
+                                                                 dialog_name, from_user=filter_user, min_id=checkpoint)
+        if self.telegram_config.cache_peers:
+            # a scan stopped at to_date didn't check the messages up to top_message, the next one shouldn't skip them
+            await self.cache_storage.finish_user_dialog(dialog_id, current_user_id,
+                                                        max(last_message_id or 0, checkpoint or 0),
+                                                        top_message if reached_top else None, self.scan_data.version)
+        self.dialogs_done += 1
+        print(f"Finished dialog {dialog_name} (ID {dialog_id}), dialogs done: {self.dialogs_done}")
 
     async def clean_chat(self, chat, client, current_user_id, dialog_id, dialog_name,
-                         from_user=None):
+                         from_user=None, min_id=None):
+        """Checks the history after min_id. Returns the last message id seen and whether the history was read to
+        the end rather than stopped at to_date."""
         total_messages = 0
         total_deleted = 0
-        async for message in client.iter_messages(chat, from_user=from_user, reverse=True,
-                                                  offset_date=self.telegram_config.from_date):
-            if message.date.replace(tzinfo=self.utc) > self.telegram_config.to_date:
-                break
+        last_message_id = None
+        reached_end = True
+        on_deleted = None
+        if self.telegram_config.cache_messages:
+            on_deleted = lambda message_ids: self.cache_storage.mark_messages_deleted(message_ids, dialog_id)
+        delete_queue = DeleteQueue(client, chat, self.limiter, on_deleted=on_deleted)
+        self.delete_queues[chat.id] = delete_queue
+        if min_id:
+            print(f"Continuing chat {dialog_name} after message {min_id}")
+        try:
+            # takeout requests have higher limits, telethon's wait between history requests only slows them down
+            wait_time = 0 if self.fetch_client is not client else None
+            async for message in self.fetch_client.iter_messages(chat, from_user=from_user, reverse=True,
+                                                                 wait_time=wait_time, **self.__history_start(min_id)):
+                message_date = message.date.replace(tzinfo=self.utc)
+                if message_date > self.telegram_config.to_date:
+                    reached_end = False
+                    break
+                last_message_id = message.id
+                if message_date < self.telegram_config.from_date:
+                    continue
+                await self.limiter.wait()
+                scan_data = self.scan_data
 
-            if self.telegram_config.cache_messages:
-                self.cache_storage.store_messages([{
-                    'id': message.id,
-                    'user_id': current_user_id,
-                    'dialog_id': dialog_id,
-                    'dialog_name': dialog_name,
-                    'message_text': getattrd(message, 'message'),
-                    'message': message.to_json(ensure_ascii=False),
-                }])
-            total_messages += 1
-            deleted = False
-            if self.telegram_config.messages.checks.forwards.enabled:
-                deleted_count = await self.check_forward_from_unwanted(chat, client, message)
-                deleted = deleted_count > 0
-
-            if not deleted:
-                if self.telegram_config.messages.enabled and (
-                        self.telegram_config.messages.checks.urls.enabled or self.telegram_config.messages.checks.keywords.enabled):
-                    deleted_count = await self.check_message_text(chat, client, message)
+                if self.telegram_config.cache_messages:
+                    message_json, message_raw = self.__cache_json(message, compact_message)
+                    await self.cache_storage.store_message({
+                        'id': message.id,
+                        'user_id': current_user_id,
+                        'dialog_id': dialog_id,
+                        'dialog_name': dialog_name,
+                        'message_text': getattrd(message, 'message'),
+                        'message': message_json,
+                        'message_raw': message_raw,
+                        'message_date': message.date,
+                    })
+                total_messages += 1
+                deleted = False
+                if self.telegram_config.messages.checks.forwards.enabled:
+                    deleted_count = await self.check_forward_from_unwanted(chat, client, message, scan_data)
                     deleted = deleted_count > 0
 
-            if deleted:
-                total_deleted += 1
-                if self.telegram_config.cache_messages:
-                    self.cache_storage.mark_message_deleted(message.id, dialog_id)
+                if not deleted:
+                    if text_checks_enabled(self.telegram_config.messages):
+                        deleted_count = await self.check_message_text(chat, client, message, scan_data)
+                        deleted = deleted_count > 0
+
+                if deleted:
+                    total_deleted += 1
+
+                if total_messages % 1000 == 0:
+                    print(f"Processed {total_messages} messages in chat: {dialog_name}")
+                if self.telegram_config.cache_peers and total_messages % CHECKPOINT_EVERY == 0:
+                    await delete_queue.drain()
+                    if self.telegram_config.cache_messages:
+                        await self.cache_storage.flush_messages()
+                    await self.cache_storage.store_dialog_checkpoint(dialog_id, current_user_id, message.id,
+                                                                     scan_data.version)
+        finally:
+            del self.delete_queues[chat.id]
+            deleted_messages = await delete_queue.close()
+            if self.telegram_config.cache_messages:
+                await self.cache_storage.flush_messages()
+        print(
+            f"Cleanup complete for chat: {dialog_name}. Total messages processed: {total_messages}, "
+            f"marked for deletion: {total_deleted}, deleted: {deleted_messages}, failed to delete: {delete_queue.failed_count}")
+        return last_message_id, reached_end
+
+    def __cache_json(self, tl_object, compact):
+        """Returns the JSON of a Telegram object in the configured cache format and its compressed full JSON."""
+        if self.telegram_config.cache_format == CACHE_FORMAT_FULL:
+            return tl_object.to_json(ensure_ascii=False), None
+        raw = compress_json(tl_object) if self.telegram_config.cache_full_json else None
+        return compact(tl_object), raw
+
+    def __history_start(self, min_id=None):
+        if min_id:
+            return {'min_id': min_id}
+        return {'offset_date': self.telegram_config.from_date}
+
+    def __search_terms(self):
+        """Unique search terms of the current scan data version, built once per version."""
+        matcher = self.matcher
+        if self.search_terms is not None and self.search_terms[0] is matcher:
+            return self.search_terms[1]
+        terms = {}
+        for entry in matcher.iter_entries():
+            check, _ = text_check_for(self.telegram_config.messages.checks, entry)
+            if check.enabled and entry.data_type != ScanDataType.TG_URL:
+                terms.setdefault(entry.data)
+        self.search_terms = (matcher, list(terms))
+        return self.search_terms[1]
+
+    async def __should_search(self, chat, client, from_user=None):
+        messages_config = self.telegram_config.messages
+        if messages_config.search_mode == SEARCH_MODE_FULL:
+            return False
+        if messages_config.checks.forwards.enabled or self.telegram_config.cache_messages:
+            # forwards can't be searched for and the cache needs every message
+            if messages_config.search_mode == SEARCH_MODE_SEARCH:
+                print("Search mode is not available with forwards check or message cache enabled, using full scan")
+            return False
+        if messages_config.search_mode == SEARCH_MODE_SEARCH:
+            return True
 
-            if total_messages % 1000 == 0:
-                print(f"Processed {total_messages} messages in chat: {dialog_name}")
+        requests_count = len(self.__search_terms()) + (1 if messages_config.checks.urls.enabled else 0)
+        history = await self.limiter.call(client.get_messages, chat, limit=0, from_user=from_user)
+        dialog_size = getattr(history, 'total', 0) or 0
+        # full scan fetches 100 messages per request, each search term costs at least one request
+        return requests_count < dialog_size / 100
+
+    async def __iter_search_results(self, chat, client, from_user=None, min_id=None):
+        checks = self.telegram_config.messages.checks
+        start = self.__history_start(min_id)
+        for term in self.__search_terms():
+            async for message in client.iter_messages(chat, search=term, from_user=from_user, reverse=True, **start):
+                yield message
+        if checks.urls.enabled:
+            async for message in client.iter_messages(chat, filter=InputMessagesFilterUrl, from_user=from_user,
+                                                      reverse=True, **start):
+                yield message
+
+    async def clean_chat_by_search(self, chat, client, dialog_name, from_user=None, min_id=None):
+        """Checks only messages Telegram finds for the scan data terms instead of the whole history."""
+        messages_config = self.telegram_config.messages
+        seen = set()
+        total_deleted = 0
+        delete_queue = DeleteQueue(client, chat, self.limiter)
+        self.delete_queues[chat.id] = delete_queue
+        print(f"Searching chat {dialog_name} for scan data terms")
+        try:
+            async for message in self.__iter_search_results(chat, client, from_user=from_user, min_id=min_id):
+                if message.id in seen:
+                    continue
+                seen.add(message.id)
+                message_date = message.date.replace(tzinfo=self.utc)
+                if message_date < self.telegram_config.from_date or message_date > self.telegram_config.to_date:
+                    continue
+                await self.limiter.wait()
+                if text_checks_enabled(messages_config):
+                    total_deleted += await self.check_message_text(chat, client, message)
+        finally:
+            del self.delete_queues[chat.id]
+            deleted_messages = await delete_queue.close()
         print(
-            f"Cleanup complete for chat: {dialog_name}. Total messages processed: {total_messages}, deleted: {total_deleted}")
+            f"Search complete for chat: {dialog_name}. Found messages checked: {len(seen)}, "
+            f"marked for deletion: {total_deleted}, deleted: {deleted_messages}, failed to delete: {delete_queue.failed_count}")
 
-    async def check_message_text(self, chat, client, message):
+    async def check_message_text(self, chat, client, message, scan_data=None):
         text = message.text
         if not text or len(text) < 5:
             return 0
 
-        if self.telegram_config.messages.checks.accounts_references.enabled:
-            for scan_entry in self.scan_data.data_by_type[ScanDataType.TG_USERNAME] + self.scan_data.data_by_type[ScanDataType.TG_USER_NAME]:
-                username = scan_entry.data
-                if "@" + username in text or "t.me/" + username in text:
-                    if await self.prompt_delete_message(chat, client, message, force=True, delete=self.telegram_config.messages.checks.accounts_references.delete,
-                                                        reason=f"========================================== Contains unwanted username: {username} ========================================== "):
-                        return 1
-            for scan_entry in self.scan_data.data_by_type[ScanDataType.INSTAGRAM_NAME] + self.scan_data.data_by_type[ScanDataType.INSTAGRAM_USERNAME]:
-                if "instagram.com/" + scan_entry.data in text:
-                    if await self.prompt_delete_message(chat, client, message, force=True, delete=self.telegram_config.messages.checks.accounts_references.delete,
-                                                        reason=f"========================================== Contains unwanted Instagram username: {scan_entry.data} ========================================== "):
-                        return 1
-
-        if self.telegram_config.messages.checks.keywords.enabled:
-            for scan_entry in self.scan_data.data_by_type[ScanDataType.TG_KEYWORD]:
-                keyword = scan_entry.data
-                if keyword in text:
-                    if await self.prompt_delete_message(chat, client, message, force=True, delete=self.telegram_config.messages.checks.keywords.delete,
-                                                        reason=f"========================================== Contains unwanted keyword: {keyword} ========================================== "):
-                        return 1
-
-        if self.telegram_config.messages.checks.urls.enabled:
-            for scan_entry in self.scan_data.data_by_type[ScanDataType.TG_URL]:
-                url = scan_entry.data
-                if url in text:
-                    if await self.prompt_delete_message(chat, client, message, force=True, delete=self.telegram_config.messages.checks.urls.delete,
-                                                        reason=f"========================================== Contains unwanted URL: {url} ========================================== "):
-                        return 1
+        for entry in (scan_data or self.scan_data).matcher.find(text):
+            check, reason = text_check_for(self.telegram_config.messages.checks, entry)
+            if not check.enabled:
+                continue
+            if await self.prompt_delete_message(chat, client, message, force=True, delete=check.delete,
+                                                reason=f"========================================== {reason} ========================================== "):
+                return 1
         return 0
 
     @staticmethod
@@ -228,38 +437,44 @@ class TelegramScanner:
                 return 0
         return 0
 
-    async def check_forward_from_unwanted(self, chat, client, message):
+    async def check_forward_from_unwanted(self, chat, client, message, scan_data=None):
+        scan_data = scan_data or self.scan_data
         forward_from = getattr(message, 'forward', None)
         if forward_from and isinstance(forward_from, Forward):
-            chat_username = self.lower(getattrd(forward_from, "chat.username"))
-            chat_title = self.lower(getattrd(forward_from, "chat.title"))
             chat_id = self.nullable_int(getattrd(forward_from, 'chat_id'))
+            source = forward_from.chat
+            if source is not None:
+                if chat_id and self.chat_cache.get(chat_id) is None:
+                    self.chat_cache.put(chat_id, source)
+            elif chat_id:
+                source = await self.chat_cache.get_chat_entity(chat_id)
+            chat_username = self.lower(getattrd(source, "username"))
+            chat_title = self.lower(getattrd(source, "title"))
             channel_id = self.nullable_int(getattrd(forward_from, 'from_id.channel_id'))
 
-            for material in self.scan_data.data:
-                if material.data_type.to_str() == ScanDataType.TG_USERNAME.to_str():
-                    username = material.data
-                    if chat_username == username or chat_title == username:
-                        if await self.prompt_delete_message(chat, client, message, force=True, delete=self.telegram_config.messages.checks.forwards.delete,
-                                                            reason=f"========================================== Forwarded from unwanted channel: {material} =========================================="):
-                            return 1
-
-                elif material.data_type.to_str() == ScanDataType.TG_USER_NAME.to_str():
-                    name = material.data
-                    if chat_username == name or chat_title == name:
-                        if await self.prompt_delete_message(chat, client, message, force=True, delete=self.telegram_config.messages.checks.forwards.delete,
-                                                            reason=f"========================================== Forwarded from unwanted channel: {material} =========================================="):
-                            return 1
-
-                elif material.data_type.to_str() == ScanDataType.TG_ID.to_str():
-                    idd = int(material.data)
-                    if chat_id == idd or chat_id == -idd or channel_id == idd or channel_id == -idd or -idd == 1000000000000 - chat_id or -idd == 1000000000000 - channel_id:
-                        if await self.prompt_delete_message(chat, client, message, force=True, delete=self.telegram_config.messages.checks.forwards.delete,
-                                                            reason=f"===================== Forwarded from unwanted channel: {material} =========================================="):
-                            return 1
+            index = scan_data.index
+            delete = self.telegram_config.messages.checks.forwards.delete
+            material = index.find_username(chat_username, chat_title) or index.find_name(chat_username, chat_title) \
+                or index.find_id(chat_id, channel_id)
+            reason = f"Forwarded from unwanted channel: {material}"
+            if not material:
+                # a similar name alone deletes only when fuzzy_titles.delete is set too
+                material = self.__find_similar_name(index, getattrd(source, "title"))
+                delete = delete and self.telegram_config.fuzzy_titles.delete
+                reason = f"Forwarded from channel with a name similar to unwanted: {material}"
+            if material:
+                if await self.prompt_delete_message(chat, client, message, force=True, delete=delete,
+                                                    reason=f"========================================== {reason} =========================================="):
+                    return 1
 
         return 0
 
+    def __find_similar_name(self, index, *titles):
+        fuzzy_titles = self.telegram_config.fuzzy_titles
+        if not fuzzy_titles.enabled:
+            return None
+        return index.find_similar_name(*titles, max_distance=fuzzy_titles.max_distance)
+
     @staticmethod
     def get_chat_title(chat):
         return first_not_null(getattrd(chat, 'title'), getattrd(chat, 'name'), getattr(chat, 'username', None))
@@ -274,8 +489,13 @@ class TelegramScanner:
         if not delete:
             return False
         if force or input("Type any button or type 'no' to skip: ") != "no":
-            await client.delete_messages(chat.id, [message.id])
-            print("Message deleted.")
+            delete_queue = self.delete_queues.get(chat.id)
+            if delete_queue:
+                delete_queue.add(message.id)
+                print("Message queued for deletion.")
+            else:
+                await self.limiter.call(client.delete_messages, chat.id, [message.id])
+                print("Message deleted.")
             print("------------------------------------------------------")
             return True
         return False
@@ -283,39 +503,86 @@ class TelegramScanner:
     async def __clean_up_from_db(self, client):
         current_user = await client.get_me()
         current_user_id = getattr(current_user, 'id')
-        tg_usernames = [item.data.lower() for item in self.scan_data if
-                        (item.data_type.to_str() == ScanDataType.TG_USERNAME.to_str())]
-        storage = PostgresStorage()
-        mentions = [item.data.lower() for item in self.scan_data if
-                    (item.data_type.to_str() == ScanDataType.TG_KEYWORD.to_str())]
-
-        total_count = storage.count_messages(current_user_id)
-        count = 0
-        for message in storage.load_messages_in_batches(current_user_id):
-            count += 1
-            if count % 10000 == 0:
-                print(f"Processed {count}/{total_count}")
-            if not message.message_text:
+        storage = self.storage or create_storage(self.config.storage)
+        scanner = OfflineScanner(self.config, self.scan_data, self.matcher, storage)
+        await asyncio.to_thread(scanner.run, current_user_id)
+
+    async def __apply_deletion_plan(self, client):
+        current_user = await client.get_me()
+        current_user_id = getattr(current_user, 'id')
+        storage = self.storage or create_storage(self.config.storage)
+        plan = await asyncio.to_thread(storage.load_deletion_plan, current_user_id)
+        print(f"Deletion plan: {sum(len(ids) for ids in plan.values())} messages in {len(plan)} dialogs")
+
+        for dialog_id, message_ids in plan.items():
+            try:
+                chat = await self.limiter.call(client.get_entity, dialog_id)
+            except ValueError:
+                print(f"Skipping dialog {dialog_id}, it is not available anymore")
                 continue
-            for tg_username in tg_usernames:
-                username = tg_username.replace("@", "").lower()
-                if f"@{username}" in message.message_text.lower() or f"t.me/{username}" in message.message_text.lower():
-                    print(message.to_str(), f"Reason: contains {username}")
+            delete_queue = DeleteQueue(client, chat, self.limiter, on_deleted=lambda deleted_ids: asyncio.to_thread(
+                storage.mark_messages_deleted, [(message_id, dialog_id) for message_id in deleted_ids]))
+            for message_id in message_ids:
+                delete_queue.add(message_id)
+            deleted_messages = await delete_queue.close()
+            print(f"Dialog {self.get_chat_title(chat)} (ID {dialog_id}): deleted {deleted_messages}, "
+                  f"failed to delete: {delete_queue.failed_count}")
+            if delete_queue.failed_count == 0:
+                await asyncio.to_thread(storage.mark_deletion_plan_applied, current_user_id, dialog_id, message_ids)
+
+    async def open_takeout(self, client, stack):
+        """Fetches histories through a takeout session closed with the stack, or with the client itself when Telegram
+        delays the session. Returns the client messages are fetched with."""
+        self.fetch_client = client
+        try:
+            self.fetch_client = await stack.enter_async_context(
+                client.takeout(finalize=True, contacts=False, users=True, chats=True, megagroups=True,
+                               channels=True, files=False))
+            print("Fetching messages through a takeout session")
+        except TakeoutInitDelayError as e:
+            print(f"Takeout session is delayed for {e.seconds}s (it can be allowed from another Telegram app), "
+                  f"fetching messages with the normal client")
+        return self.fetch_client
 
     async def __process(self, client, phone_number):
         await login(client, phone_number)
-        await self.__clean_up_telegram(client)
+        async with AsyncExitStack() as stack:
+            self.fetch_client = client
+            self.chat_cache = ChatCache(os.path.join(self.config.paths.cache_dir, 'chat_cache.json'), client,
+                                        limiter=self.limiter)
+            if self.telegram_config.takeout:
+                await self.open_takeout(client, stack)
+            watcher = None
+            if self.config.paths.scan_data_reload_interval > 0:
+                watcher = asyncio.create_task(self.__watch_scan_data())
+            try:
+                await self.__clean_up_telegram(client)
+            finally:
+                if watcher:
+                    watcher.cancel()
+                self.chat_cache.close()
+                if self.cache_storage:
+                    await self.cache_storage.close()
 
     async def __process_from_db(self, client, phone_number):
         await login(client, phone_number)
         await self.__clean_up_from_db(client)
 
+    async def __process_deletion_plan(self, client, phone_number):
+        await login(client, phone_number)
+        await self.__apply_deletion_plan(client)
+
     def scan(self):
         cache_dir = self.config.paths.cache_dir
         phone_number = get_phone_number(cache_dir)
         client = create_client(phone_number, cache_dir, self.config.telegram.api_id, self.config.telegram.api_hash)
+        process = {
+            MODE_ONLINE: self.__process,
+            MODE_OFFLINE: self.__process_from_db,
+            MODE_APPLY_PLAN: self.__process_deletion_plan,
+        }[self.telegram_config.mode]
         with client:
-            client.loop.run_until_complete(self.__process(client, phone_number))
+            client.loop.run_until_complete(process(client, phone_number))
 
 #
 # if __name__ == "__main__":
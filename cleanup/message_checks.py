@@ -0,0 +1,92 @@
+from cleanup.docextract.scan_data import ScanDataType, normalize_tg_id
+from cleanup.docextract.scan_matcher import ScanDataMatcher
+
+# keys of the cached message JSON read by the checks
+CHECKED_MESSAGE_KEYS = ('fwd_from', 'entities', 'media')
+
+
+def text_check_for(checks, entry):
+    """Returns the check setting and the reason for a scan data entry found in a message text."""
+    if entry.data_type in (ScanDataType.TG_USERNAME, ScanDataType.TG_USER_NAME):
+        return checks.accounts_references, f"Contains unwanted username: {entry.data}"
+    if entry.data_type in (ScanDataType.INSTAGRAM_NAME, ScanDataType.INSTAGRAM_USERNAME):
+        return checks.accounts_references, f"Contains unwanted Instagram username: {entry.data}"
+    if entry.data_type == ScanDataType.TG_KEYWORD:
+        return checks.keywords, f"Contains unwanted keyword: {entry.data}"
+    return checks.urls, f"Contains unwanted URL: {entry.data}"
+
+
+def text_checks_enabled(messages_config):
+    return messages_config.enabled and (messages_config.checks.urls.enabled or messages_config.checks.keywords.enabled)
+
+
+def cached_message_text(message_text, message_json):
+    """Text of a cached message extended with link targets, the cached counterpart of Telethon's message.text."""
+    parts = [message_text or '']
+    for entity in (message_json or {}).get('entities') or []:
+        if entity.get('url'):
+            parts.append(entity['url'])
+    webpage_url = (((message_json or {}).get('media') or {}).get('webpage') or {}).get('url')
+    if webpage_url:
+        parts.append(webpage_url)
+    return ' '.join(parts)
+
+
+class CachedMessageChecker:
+    """Applies the message checks of TelegramScanner.clean_chat to messages from the cache."""
+
+    def __init__(self, telegram_config, scan_data, matcher: ScanDataMatcher, peer_names=None):
+        self.messages_config = telegram_config.messages
+        self.fuzzy_titles = telegram_config.fuzzy_titles
+        self.checks = telegram_config.messages.checks
+        self.index = scan_data.index
+        self.matcher = matcher
+        # normalized peer ID -> (username, title) of peers known from the cache
+        self.peer_names = peer_names or {}
+
+    def check_forward(self, message_json):
+        """Returns (reason, delete) if the message is forwarded from an unwanted source, None otherwise. Sources
+        matched only by a similar name are deleted when fuzzy_titles.delete is set too."""
+        fwd_from = (message_json or {}).get('fwd_from')
+        if not fwd_from:
+            return None
+        from_id = fwd_from.get('from_id') or {}
+        peer_ids = [from_id.get(key) for key in ('channel_id', 'chat_id', 'user_id') if from_id.get(key)]
+        # chat_username and chat_title are only cached in the compact format
+        names = [fwd_from.get('from_name'), fwd_from.get('chat_username'), fwd_from.get('chat_title')]
+        titles = [fwd_from.get('from_name'), fwd_from.get('chat_title')]
+        for peer_id in peer_ids:
+            username, title = self.peer_names.get(normalize_tg_id(peer_id), (None, None))
+            names.extend((username, title))
+            titles.append(title)
+        entry = self.index.find_username(*names) or self.index.find_name(*names) or self.index.find_id(*peer_ids)
+        if entry:
+            return f"Forwarded from unwanted channel: {entry}", self.checks.forwards.delete
+        if self.fuzzy_titles.enabled:
+            entry = self.index.find_similar_name(*titles, max_distance=self.fuzzy_titles.max_distance)
+            if entry:
+                return (f"Forwarded from channel with a name similar to unwanted: {entry}",
+                        self.checks.forwards.delete and self.fuzzy_titles.delete)
+        return None
+
+    def check(self, message_text, message_json):
+        """Returns [(reason, delete)] for every violation up to and including the first one to delete,
+        in the order the online scan reports them."""
+        violations = []
+        if self.checks.forwards.enabled:
+            violation = self.check_forward(message_json)
+            if violation:
+                violations.append(violation)
+                if violation[1]:
+                    return violations
+
+        text = cached_message_text(message_text, message_json)
+        if text_checks_enabled(self.messages_config) and len(text) >= 5:
+            for entry in self.matcher.find(text):
+                check, reason = text_check_for(self.checks, entry)
+                if not check.enabled:
+                    continue
+                violations.append((reason, check.delete))
+                if check.delete:
+                    break
+        return violations
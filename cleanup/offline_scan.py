@@ -0,0 +1,125 @@
+import heapq
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import groupby
+
+from cleanup.config.scan_config import Config
+from cleanup.docextract.scan_data import ScanData, ScanDataEntry, normalize_tg_id
+from cleanup.docextract.scan_matcher import ScanDataMatcher
+from cleanup.message_checks import CachedMessageChecker, text_check_for, text_checks_enabled, CHECKED_MESSAGE_KEYS
+from cleanup.storage.base import Storage
+from cleanup.storage.factory import create_storage
+
+# state of a pool worker process, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(config: Config, scan_data: ScanData, matcher: ScanDataMatcher):
+    # the parent opened the storage and migrated it before starting the pool
+    storage = create_storage(config.storage, pool_size=1, migrate=False)
+    peer_names = {normalize_tg_id(peer_id): names for peer_id, names in storage.load_peer_names().items()}
+    _worker['config'] = config
+    _worker['matcher'] = matcher
+    _worker['storage'] = storage
+    _worker['checker'] = CachedMessageChecker(config.telegram, scan_data, matcher, peer_names)
+
+
+def _scan_shard(user_id, dialog_ids):
+    """Checks cached messages of the dialogs, returns [(dialog_id, message_id, reason, delete)]."""
+    telegram_config = _worker['config'].telegram
+    storage = _worker['storage']
+    checker = _worker['checker']
+
+    if not telegram_config.offline.pushdown:
+        violations = []
+        for message in storage.load_messages_in_batches(user_id, dialog_ids=dialog_ids,
+                                                        from_date=telegram_config.from_date,
+                                                        to_date=telegram_config.to_date,
+                                                        columns=('message_text', 'message'),
+                                                        message_keys=CHECKED_MESSAGE_KEYS):
+            for reason, delete in checker.check(message.message_text, message.message):
+                violations.append((message.dialog_id, message.id, reason, delete))
+        return violations
+
+    # text checks run inside Postgres, only forwarded messages are loaded to check their source
+    checks = telegram_config.messages.checks
+    violations = []
+    forward_deleted = set()
+    if checks.forwards.enabled:
+        for message in storage.load_messages_in_batches(user_id, dialog_ids=dialog_ids, forwarded_only=True,
+                                                        from_date=telegram_config.from_date,
+                                                        to_date=telegram_config.to_date,
+                                                        columns=('message',), message_keys=('fwd_from',)):
+            violation = checker.check_forward(message.message)
+            if violation:
+                reason, delete = violation
+                violations.append((message.dialog_id, message.id, reason, delete))
+                if delete:
+                    forward_deleted.add((message.dialog_id, message.id))
+    if text_checks_enabled(telegram_config.messages):
+        patterns = [(pattern, entry.data, entry.data_type.to_str()) for pattern, entry in _worker['matcher'].patterns()
+                    if text_check_for(checks, entry)[0].enabled]
+        matches = storage.find_scan_matches(user_id, patterns, dialog_ids, telegram_config.from_date,
+                                            telegram_config.to_date)
+        for (dialog_id, message_id), rows in groupby(matches, key=lambda row: (row[1], row[0])):
+            if (dialog_id, message_id) in forward_deleted:
+                continue
+            # like CachedMessageChecker.check: every entry once, up to and including the first one to delete
+            found = set()
+            for _, _, data, data_type in rows:
+                if (data, data_type) in found:
+                    continue
+                found.add((data, data_type))
+                check, reason = text_check_for(checks, ScanDataEntry.from_dict({'data': data, 'data_type': data_type}))
+                violations.append((dialog_id, message_id, reason, check.delete))
+                if check.delete:
+                    break
+    return violations
+
+
+def make_shards(counts: dict[int, int], shard_count: int) -> list[list[int]]:
+    """Splits dialogs into shards with close total message counts, largest dialogs first."""
+    shards = [(0, i, []) for i in range(max(1, shard_count))]
+    for dialog_id, count in sorted(counts.items(), key=lambda item: -item[1]):
+        total, i, dialog_ids = heapq.heappop(shards)
+        dialog_ids.append(dialog_id)
+        heapq.heappush(shards, (total + count, i, dialog_ids))
+    return [dialog_ids for _, _, dialog_ids in sorted(shards, key=lambda shard: shard[1]) if dialog_ids]
+
+
+class OfflineScanner:
+    """Runs the message checks over the message cache in a process pool, sharded by dialog, and stores
+    the messages to delete as a deletion plan for a later online pass."""
+
+    def __init__(self, config: Config, scan_data: ScanData, matcher: ScanDataMatcher, storage: Storage):
+        self.config = config
+        self.scan_data = scan_data
+        self.matcher = matcher
+        self.storage = storage
+
+    def run(self, user_id):
+        counts = self.storage.count_messages_by_dialog(user_id, self.config.telegram.from_date,
+                                                       self.config.telegram.to_date)
+        total_count = sum(counts.values())
+        workers = max(1, self.config.telegram.offline.workers)
+        shards = make_shards(counts, workers * 4)
+        print(f"Checking {total_count} cached messages in {len(counts)} dialogs with {workers} workers")
+
+        plan = []
+        processed = 0
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(self.config, self.scan_data, self.matcher)) as pool:
+            futures = {pool.submit(_scan_shard, user_id, shard): shard for shard in shards}
+            for future in as_completed(futures):
+                violations = future.result()
+                processed += sum(counts[dialog_id] for dialog_id in futures[future])
+                for dialog_id, message_id, reason, delete in violations:
+                    print(f"[dialog: {dialog_id}] [message: {message_id}] Reason: {reason}")
+                    if delete:
+                        plan.append((dialog_id, message_id, reason))
+                print(f"Processed {processed}/{total_count}")
+
+        self.storage.store_deletion_plan(user_id, plan)
+        print(f"Deletion plan stored: {len(plan)} messages in {len({item[0] for item in plan})} dialogs")
+        return plan
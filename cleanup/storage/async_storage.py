@@ -0,0 +1,105 @@
+import asyncio
+import atexit
+import concurrent.futures
+import logging
+import queue
+import threading
+
+from cleanup.storage.base import MessageBuffer
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class AsyncStorage:
+    """Async front end of a storage: every call runs on one writer thread, so database round-trips never block
+    the event loop. Writes are queued (awaiting only when the queue is full), reads wait for their result and see
+    every write queued before them."""
+
+    def __init__(self, storage, max_pending=10000, message_batch_size=1000, flush_interval=5.0):
+        self.storage = storage
+        self.message_buffer = MessageBuffer(storage, batch_size=message_batch_size, flush_interval=flush_interval)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name="storage-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close_sync)
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.message_buffer.flush_interval)
+            except queue.Empty:
+                self._flush_messages()
+                continue
+            if item is _STOP:
+                self._flush_messages()
+                return
+            method, args, future = item
+            try:
+                result = method(*args)
+                if future is not None:
+                    future.set_result(result)
+            except Exception as e:
+                if future is not None:
+                    future.set_exception(e)
+                else:
+                    logger.exception("Storage write %s failed", method.__name__)
+            if self.message_buffer.is_due():
+                self._flush_messages()
+
+    def _flush_messages(self):
+        try:
+            self.message_buffer.flush()
+        except Exception:
+            # the rows stay pending, the next flush retries them
+            logger.exception("Failed flushing %s cached messages", len(self.message_buffer.pending))
+
+    async def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            # backpressure: wait for the writer instead of growing the queue
+            await asyncio.to_thread(self._queue.put, item)
+
+    async def write(self, method, *args):
+        await self._put((method, args, None))
+
+    async def read(self, method, *args):
+        future = concurrent.futures.Future()
+        await self._put((method, args, future))
+        return await asyncio.wrap_future(future)
+
+    async def store_message(self, message):
+        await self.write(self.message_buffer.add, message)
+
+    async def mark_messages_deleted(self, message_ids, dialog_id):
+        await self.write(self.message_buffer.mark_deleted, [(message_id, dialog_id) for message_id in message_ids])
+
+    async def flush_messages(self):
+        await self.read(self.message_buffer.flush)
+
+    async def store_peer(self, peers):
+        await self.write(self.storage.store_peer, peers)
+
+    async def store_user_dialog(self, dialog_id, user_id, config_hash=None, from_date=None, to_date=None):
+        return await self.read(self.storage.store_user_dialog, dialog_id, user_id, config_hash, from_date, to_date)
+
+    async def store_dialog_checkpoint(self, dialog_id, user_id, last_message_id, scan_data_version=None):
+        await self.write(self.storage.store_dialog_checkpoint, dialog_id, user_id, last_message_id, scan_data_version)
+
+    async def finish_user_dialog(self, dialog_id, user_id, scanned_message_id, scanned_top_message,
+                                 scan_data_version=None):
+        await self.write(self.storage.finish_user_dialog, dialog_id, user_id, scanned_message_id, scanned_top_message,
+                         scan_data_version)
+
+    async def close(self):
+        """Writes everything still queued or buffered and stops the writer thread."""
+        if self._thread.is_alive():
+            await self._put(_STOP)
+            await asyncio.to_thread(self._thread.join)
+
+    def close_sync(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
@@ -0,0 +1,236 @@
+import json
+import logging
+import time
+from abc import ABC, abstractmethod
+
+logger = logging.getLogger(__name__)
+
+
+# columns load_messages_in_batches can load besides id and dialog_id
+MESSAGE_COLUMNS = ('dialog_name', 'message_text', 'message')
+
+
+def check_message_columns(columns):
+    unknown = set(columns) - set(MESSAGE_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown message columns: {', '.join(sorted(unknown))}")
+
+
+def like_escape(value):
+    """Escapes LIKE/ILIKE wildcards so value is matched literally."""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class TgMessage:
+    """Cached message row. The message JSON can be passed as text (message_json), it is decoded on first access."""
+    __slots__ = ('id', 'user_id', 'dialog_id', 'dialog_name', 'message_text', '_message', '_message_json')
+
+    def __init__(self, user_id: int, dialog_id: int, dialog_name: str = None, message_text: str = None,
+                 message: dict = None, id: int = None, message_json: str = None):
+        self.id = id
+        self.user_id = user_id
+        self.dialog_id = dialog_id
+        self.dialog_name = dialog_name
+        self.message_text = message_text
+        self._message = message
+        self._message_json = message_json
+
+    @property
+    def message(self) -> dict:
+        if self._message is None and self._message_json is not None:
+            self._message = json.loads(self._message_json)
+            self._message_json = None
+        return self._message
+
+    @classmethod
+    def from_row(cls, user_id, columns, row):
+        """Message of a (id, dialog_id, *columns) row, a message column holds JSON text."""
+        message = cls(user_id=user_id, dialog_id=row[1], id=row[0])
+        for column, value in zip(columns, row[2:]):
+            if column == 'message':
+                message._message_json = value
+            else:
+                setattr(message, column, value)
+        return message
+
+    def to_str(self):
+        return f"TgMessage(id={self.id}, user_id={self.user_id}, dialog_id={self.dialog_id}, dialog_name='{self.dialog_name}', message_text='{self.message_text}', message={self.message})"
+
+
+class MessageBuffer:
+    """Collects message rows and writes them with one statement per batch instead of one per message.
+
+    While writes fail, rows are kept up to max_pending and retried every flush_interval; rows over the limit are
+    dropped and counted, the cache misses them but the scan goes on."""
+
+    def __init__(self, storage, batch_size=1000, flush_interval=5.0, max_pending=10000):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max(max_pending, batch_size)
+        self.pending: dict[tuple[int, int], dict] = {}
+        self.last_flush = time.monotonic()
+        self.failing = False
+        self.dropped = 0
+
+    def add(self, message):
+        key = (message['id'], message['dialog_id'])
+        if key not in self.pending and len(self.pending) >= self.max_pending:
+            if not self.dropped:
+                logger.warning("Storing cached messages keeps failing, dropping messages over %s pending",
+                               self.max_pending)
+            self.dropped += 1
+        else:
+            # a batch can't upsert the same row twice, the latest version wins
+            self.pending[key] = message
+        # a full batch is written right away unless the last write failed, retries wait for flush_interval
+        if (len(self.pending) >= self.batch_size and not self.failing) or self.is_due():
+            self.flush()
+
+    def mark_deleted(self, pairs):
+        """Marks (message_id, dialog_id) pairs deleted, rows not written yet are patched in the buffer."""
+        stored = []
+        for pair in pairs:
+            message = self.pending.get(pair)
+            if message is not None:
+                message['deleted'] = True
+            else:
+                stored.append(pair)
+        self.storage.mark_messages_deleted(stored)
+
+    def is_due(self):
+        return time.monotonic() - self.last_flush >= self.flush_interval
+
+    def flush(self):
+        """Writes the pending rows. Rows of a failed write stay pending, add retries them after flush_interval."""
+        self.failing = True
+        try:
+            if self.pending:
+                self.storage.store_messages(list(self.pending.values()))
+                self.pending = {}
+            self.failing = False
+        finally:
+            self.last_flush = time.monotonic()
+        if self.dropped:
+            logger.warning("Dropped %s cached messages while storing them failed", self.dropped)
+            self.dropped = 0
+
+
+class Storage(ABC):
+    """Message and dialog cache used by the scanner, implemented by PostgresStorage and SqliteStorage.
+
+    Message rows are dicts with id, user_id, dialog_id, dialog_name, message_text, message (JSON text),
+    message_date, optional message_raw and deleted. Peer rows are dicts with id, title, username, peer_type, data
+    and optional data_raw, users_count, full_chat_data, full_chat_data_raw."""
+
+    @abstractmethod
+    def store_messages(self, messages):
+        pass
+
+    @abstractmethod
+    def store_peer(self, peers):
+        pass
+
+    @abstractmethod
+    def store_full_chat_data(self, peer_id, full_chat_data, full_chat_data_raw=None):
+        pass
+
+    @abstractmethod
+    def store_users_count(self, peer_id, users_count):
+        pass
+
+    @abstractmethod
+    def store_user_dialog(self, dialog_id, user_id, config_hash=None, from_date=None, to_date=None):
+        """Registers the dialog, progress and watermark are reset when config_hash differs from the stored one or
+        from_date moves earlier than the scanned range. A processed dialog stays processed only while to_date doesn't
+        move later, the watermark covers that part. Returns the dialog state
+        (processed, last_message_id, scanned_message_id, scanned_top_message) after the upsert."""
+
+    @abstractmethod
+    def store_dialog_checkpoint(self, dialog_id, user_id, last_message_id, scan_data_version=None):
+        """Stores the resume point of the dialog and the scan data version its messages were checked against."""
+
+    @abstractmethod
+    def get_dialog_checkpoint(self, dialog_id, user_id):
+        pass
+
+    @abstractmethod
+    def mark_dialog_processed(self, dialog_id, user_id):
+        pass
+
+    @abstractmethod
+    def get_is_dialog_processed(self, dialog_id, user_id):
+        pass
+
+    @abstractmethod
+    def store_dialog_watermark(self, dialog_id, user_id, scanned_message_id, scanned_top_message):
+        pass
+
+    @abstractmethod
+    def finish_user_dialog(self, dialog_id, user_id, scanned_message_id, scanned_top_message, scan_data_version=None):
+        """Marks the dialog processed and stores the watermark of the finished scan and its scan data version."""
+
+    @abstractmethod
+    def get_dialog_watermark(self, dialog_id, user_id):
+        """Returns (scanned_message_id, scanned_top_message) of the last complete scan of the dialog."""
+
+    def mark_message_deleted(self, message_id, dialog_id):
+        self.mark_messages_deleted([(message_id, dialog_id)])
+
+    @abstractmethod
+    def mark_messages_deleted(self, pairs):
+        """Marks cached messages deleted by (message_id, dialog_id) pairs."""
+
+    @abstractmethod
+    def search_peer(self, id):
+        pass
+
+    @abstractmethod
+    def search_messages(self, query, field="dialog_name"):
+        pass
+
+    @abstractmethod
+    def search_message_text(self, query, user_id=None, include_deleted=False, limit=100) -> list[TgMessage]:
+        """Case-insensitive substring search over cached message texts."""
+
+    @abstractmethod
+    def count_messages(self, user_id, from_date=None, to_date=None):
+        pass
+
+    @abstractmethod
+    def load_messages_in_batches(self, user_id, batch_size=1000, dialog_ids=None, forwarded_only=False,
+                                 from_date=None, to_date=None, columns=MESSAGE_COLUMNS,
+                                 message_keys=None) -> list[TgMessage]:
+        """Yields not deleted cached messages of the user. Only id, dialog_id and the given columns are loaded,
+        message_keys limits the message JSON to these top-level keys."""
+
+    @abstractmethod
+    def count_messages_by_dialog(self, user_id, from_date=None, to_date=None):
+        """Returns {dialog_id: count} of not deleted cached messages."""
+
+    @abstractmethod
+    def load_peer_names(self):
+        """Returns {peer_id: (username, title)} of cached peers."""
+
+    @abstractmethod
+    def store_deletion_plan(self, user_id, items):
+        """Stores (dialog_id, message_id, reason) items to be deleted by a later online pass."""
+
+    @abstractmethod
+    def load_deletion_plan(self, user_id):
+        """Returns {dialog_id: [message_id]} of planned deletions not applied yet."""
+
+    @abstractmethod
+    def mark_deletion_plan_applied(self, user_id, dialog_id, message_ids):
+        pass
+
+    @abstractmethod
+    def find_scan_matches(self, user_id, patterns, dialog_ids=None, from_date=None, to_date=None):
+        """Finds cached messages containing any of the patterns inside the database.
+
+        patterns is a list of (pattern, data, data_type) in check order. Returns (id, dialog_id, data, data_type)
+        for every pattern a message contains, ordered by dialog_id and id, the patterns of a message in check order."""
+
+    @abstractmethod
+    def close_connection(self):
+        pass
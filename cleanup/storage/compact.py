@@ -0,0 +1,74 @@
+import json
+import zlib
+
+from cleanup.utils import getattrd
+
+# the compact format keeps the key layout of Telethon's to_json, so cached rows in either format are read alike
+
+
+def _type_name(tl_object):
+    return type(tl_object).__name__
+
+
+def _peer(peer):
+    return peer.to_dict() if peer is not None else None
+
+
+def compact_message_dict(message):
+    """The fields of a Telethon message the message checks read: text, date, forward source, link entities and
+    the web preview URL."""
+    data = {'_': 'Message', 'id': message.id, 'date': message.date.isoformat() if message.date else None,
+            'message': message.message}
+    fwd_from = getattr(message, 'fwd_from', None)
+    if fwd_from is not None:
+        data['fwd_from'] = {
+            '_': 'MessageFwdHeader',
+            'from_id': _peer(fwd_from.from_id),
+            'from_name': fwd_from.from_name,
+            # names of the source chat are only known from entities Telethon already has, no requests are made
+            'chat_username': getattrd(message, 'forward.chat.username'),
+            'chat_title': getattrd(message, 'forward.chat.title'),
+        }
+    entities = [{'_': _type_name(entity), 'url': entity.url} for entity in message.entities or ()
+                if getattr(entity, 'url', None)]
+    if entities:
+        data['entities'] = entities
+    webpage_url = getattrd(message, 'media.webpage.url')
+    if webpage_url:
+        data['media'] = {'_': 'MessageMediaWebPage', 'webpage': {'_': 'WebPage', 'url': webpage_url}}
+    return data
+
+
+def compact_message(message):
+    return json.dumps(compact_message_dict(message), ensure_ascii=False)
+
+
+def compact_peer(chat):
+    """Identity of a user, chat or channel without photos, restrictions and the other flags."""
+    data = {'_': _type_name(chat), 'id': chat.id, 'username': getattr(chat, 'username', None)}
+    for field in ('title', 'first_name', 'last_name', 'broadcast', 'megagroup'):
+        value = getattr(chat, field, None)
+        if value is not None:
+            data[field] = value
+    return json.dumps(data, ensure_ascii=False)
+
+
+def compact_full_chat(full_chat_info):
+    """Part of messages.ChatFull used by the scan: participants count, description and the linked chat."""
+    full_chat = full_chat_info.full_chat
+    return json.dumps({'_': _type_name(full_chat_info), 'full_chat': {
+        '_': _type_name(full_chat),
+        'id': full_chat.id,
+        'participants_count': getattr(full_chat, 'participants_count', None),
+        'about': getattr(full_chat, 'about', None),
+        'linked_chat_id': getattr(full_chat, 'linked_chat_id', None),
+    }}, ensure_ascii=False)
+
+
+def compress_json(tl_object, level=1):
+    """Full to_json of a Telethon object compressed with zlib."""
+    return zlib.compress(tl_object.to_json(ensure_ascii=False).encode(), level)
+
+
+def decompress_json(data):
+    return json.loads(zlib.decompress(data)) if data is not None else None
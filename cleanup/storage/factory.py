@@ -0,0 +1,12 @@
+from cleanup.config.scan_config import StorageConfig, STORAGE_BACKEND_SQLITE
+from cleanup.storage.base import Storage
+
+
+def create_storage(storage_config: StorageConfig, pool_size=None, migrate=True) -> Storage:
+    """Opens the configured cache backend, psycopg2 is only needed for Postgres. migrate=False opens a database
+    already migrated by another process without touching its schema."""
+    if storage_config.backend == STORAGE_BACKEND_SQLITE:
+        from cleanup.storage.sqlite import SqliteStorage
+        return SqliteStorage(path=storage_config.path, migrate=migrate)
+    from cleanup.storage.pg import PostgresStorage
+    return PostgresStorage(dsn=storage_config.dsn, pool_size=pool_size or storage_config.pool_size, migrate=migrate)
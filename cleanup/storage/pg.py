@@ -1,26 +1,54 @@
-import psycopg2
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
 from psycopg2 import sql
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+from cleanup.storage.base import Storage, TgMessage, like_escape, MESSAGE_COLUMNS, check_message_columns
+
+DEFAULT_DSN = "dbname=messages_db user=postgres password=password host=localhost port=5499"
 
+# schema migrations run once per process for each database
+_migrated_dsns = set()
+_migration_lock = threading.Lock()
 
-class TgMessage:
-    def __init__(self, user_id: int, dialog_id: int, dialog_name: str, message_text: str, message: dict):
-        self.user_id = user_id
-        self.dialog_id = dialog_id
-        self.dialog_name = dialog_name
-        self.message_text = message_text
-        self.message = message
 
-    def to_str(self):
-        return f"TgMessage(user_id={self.user_id}, dialog_id={self.dialog_id}, dialog_name='{self.dialog_name}', message_text='{self.message_text}', message={self.message})"
+class PostgresStorage(Storage):
+    def __init__(self, dsn=DEFAULT_DSN, pool_size=5, migrate=True):
+        """migrate=False skips the schema migrations, for processes opening a database another process migrated:
+        its ALTER TABLE statements lock the tables even when there's nothing to change."""
+        self.dsn = dsn
+        self.pool = ThreadedConnectionPool(1, pool_size, dsn)
+        # (year, month) of message partitions known to exist
+        self._known_partitions = set()
+        if not migrate:
+            return
+        with _migration_lock:
+            if dsn not in _migrated_dsns:
+                self._initialize_tables()
+                _migrated_dsns.add(dsn)
 
+    @classmethod
+    def from_config(cls, storage_config):
+        return cls(dsn=storage_config.dsn, pool_size=storage_config.pool_size)
 
-class PostgresStorage:
-    def __init__(self, db_name="messages_db", user="postgres", password="password", host="localhost", port="5499"):
-        self.conn = psycopg2.connect(dbname=db_name, user=user, password=password, host=host, port=port)
-        self._initialize_tables()
+    @contextmanager
+    def _connection(self):
+        """Borrows a pooled connection, commits on success and rolls back on error."""
+        conn = self.pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
 
     def _initialize_tables(self):
-        with self.conn.cursor() as cursor:
+        with self._connection() as conn, conn.cursor() as cursor:
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS peer (
                     id BIGINT PRIMARY KEY,
@@ -33,17 +61,8 @@ class PostgresStorage:
                     created_at TIMESTAMP DEFAULT NOW()
                 );
                 
-                CREATE TABLE IF NOT EXISTS message (
-                    id BIGINT,
-                    user_id BIGINT,
-                    dialog_id BIGINT,
-                    dialog_name TEXT,
-                    message_text TEXT,
-                    message JSONB,
-                    deleted BOOLEAN DEFAULT FALSE,
-                    created_at TIMESTAMP DEFAULT NOW(),
-                    primary key (id, dialog_id)
-                );
+                alter table peer add column if not exists data_raw BYTEA;
+                alter table peer add column if not exists full_chat_data_raw BYTEA;
                 
                 create table if not exists user_dialog (
                     dialog_id BIGINT,
@@ -51,119 +70,401 @@ class PostgresStorage:
                     processed boolean default false,
                     primary key (dialog_id, user_id)
                 );
+                
+                alter table user_dialog add column if not exists config_hash TEXT;
+                alter table user_dialog add column if not exists last_message_id BIGINT;
+                alter table user_dialog add column if not exists scanned_message_id BIGINT;
+                alter table user_dialog add column if not exists scanned_top_message BIGINT;
+                alter table user_dialog add column if not exists scan_data_version TEXT;
+                alter table user_dialog add column if not exists scan_from_date TIMESTAMPTZ;
+                alter table user_dialog add column if not exists scan_to_date TIMESTAMPTZ;
+                
+                create table if not exists deletion_plan (
+                    user_id BIGINT,
+                    dialog_id BIGINT,
+                    message_id BIGINT,
+                    reason TEXT,
+                    applied boolean default false,
+                    created_at TIMESTAMP DEFAULT NOW(),
+                    primary key (user_id, dialog_id, message_id)
+                );
+                
+                CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            ''')
+            self._initialize_message_table(cursor)
+            cursor.execute('''
+                ALTER TABLE message ADD COLUMN IF NOT EXISTS message_raw BYTEA;
+                CREATE INDEX IF NOT EXISTS message_user_id_not_deleted_idx ON message (user_id) WHERE NOT deleted;
+                CREATE INDEX IF NOT EXISTS message_text_trgm_idx ON message USING gin (message_text gin_trgm_ops);
             ''')
-            self.conn.commit()
+
+    def _initialize_message_table(self, cursor):
+        """Creates the message table partitioned by month of message_date, a message table from before
+        partitioning is moved into it."""
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('message');")
+        row = cursor.fetchone()
+        relkind = row[0] if row else None
+        if relkind == 'p':
+            return
+        if relkind == 'r':
+            cursor.execute('''
+                DROP INDEX IF EXISTS message_user_id_not_deleted_idx;
+                DROP INDEX IF EXISTS message_text_trgm_idx;
+                ALTER TABLE message RENAME CONSTRAINT message_pkey TO message_legacy_pkey;
+                ALTER TABLE message RENAME TO message_legacy;
+            ''')
+        cursor.execute('''
+            CREATE TABLE message (
+                id BIGINT,
+                user_id BIGINT,
+                dialog_id BIGINT,
+                dialog_name TEXT,
+                message_text TEXT,
+                message JSONB,
+                deleted BOOLEAN DEFAULT FALSE,
+                created_at TIMESTAMP DEFAULT NOW(),
+                message_date TIMESTAMPTZ NOT NULL,
+                primary key (id, dialog_id, message_date)
+            ) PARTITION BY RANGE (message_date);
+        ''')
+        if relkind == 'r':
+            cursor.execute('''
+                SELECT DISTINCT date_trunc('month', COALESCE((message->>'date')::timestamptz, created_at), 'UTC')
+                FROM message_legacy;
+            ''')
+            self._create_month_partitions(cursor, [row[0] for row in cursor.fetchall()])
+            cursor.execute('''
+                INSERT INTO message (id, user_id, dialog_id, dialog_name, message_text, message, deleted, created_at,
+                                     message_date)
+                SELECT id, user_id, dialog_id, dialog_name, message_text, message, deleted, created_at,
+                       COALESCE((message->>'date')::timestamptz, created_at)
+                FROM message_legacy;
+                DROP TABLE message_legacy;
+            ''')
+
+    @staticmethod
+    def _month_of(date):
+        date = date.astimezone(timezone.utc)
+        return date.year, date.month
+
+    def _create_month_partitions(self, cursor, dates):
+        for year, month in sorted({self._month_of(date) for date in dates}):
+            start = datetime(year, month, 1, tzinfo=timezone.utc)
+            end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+            cursor.execute(sql.SQL('''
+                CREATE TABLE IF NOT EXISTS {} PARTITION OF message FOR VALUES FROM (%s) TO (%s);
+            ''').format(sql.Identifier(f"message_y{year:04d}m{month:02d}")), (start, end))
+            self._known_partitions.add((year, month))
+
+    def drop_message_partitions_before(self, date):
+        """Drops cached messages of every month that ended before date, a whole partition at a time."""
+        dropped = []
+        with self._connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'message'::regclass;
+            ''')
+            for (name,) in cursor.fetchall():
+                year, month = int(name[9:13]), int(name[14:16])
+                end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+                if end <= date:
+                    cursor.execute(sql.SQL('DROP TABLE {};').format(sql.Identifier(name)))
+                    self._known_partitions.discard((year, month))
+                    dropped.append(name)
+        return dropped
 
     def store_messages(self, messages):
-        with self.conn.cursor() as cursor:
-            for message in messages:
-                cursor.execute('''
-                    INSERT INTO message (id, user_id, dialog_id, dialog_name, message, message_text)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    ON CONFLICT ON CONSTRAINT message_pkey DO UPDATE SET
-                        user_id = EXCLUDED.user_id,
-                        dialog_id = EXCLUDED.dialog_id,
-                        dialog_name = EXCLUDED.dialog_name,
-                        message_text = EXCLUDED.message_text,
-                        message = EXCLUDED.message,
-                        deleted = EXCLUDED.deleted;
-                ''', (
-                    message['id'], message['user_id'], message['dialog_id'], message['dialog_name'], message['message'],
-                    message['message_text']))
-            self.conn.commit()
+        rows = [(message['id'], message['user_id'], message['dialog_id'], message['dialog_name'], message['message'],
+                 message['message_text'], message.get('deleted', False), message['message_date'],
+                 message.get('message_raw'))
+                for message in messages]
+        if not rows:
+            return
+        with self._connection() as conn, conn.cursor() as cursor:
+            new_months = {row[7] for row in rows if self._month_of(row[7]) not in self._known_partitions}
+            if new_months:
+                self._create_month_partitions(cursor, new_months)
+            execute_values(cursor, '''
+                INSERT INTO message (id, user_id, dialog_id, dialog_name, message, message_text, deleted, message_date,
+                                     message_raw)
+                VALUES %s
+                ON CONFLICT (id, dialog_id, message_date) DO UPDATE SET
+                    user_id = EXCLUDED.user_id,
+                    dialog_id = EXCLUDED.dialog_id,
+                    dialog_name = EXCLUDED.dialog_name,
+                    message_text = EXCLUDED.message_text,
+                    message = EXCLUDED.message,
+                    message_raw = COALESCE(EXCLUDED.message_raw, message.message_raw),
+                    deleted = EXCLUDED.deleted;
+            ''', rows, page_size=len(rows))
 
     def store_peer(self, peers):
-        with self.conn.cursor() as cursor:
-            for user in peers:
-                cursor.execute('''
-                    INSERT INTO peer (id, title, username, peer_type, data, users_count)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (id) DO UPDATE SET
-                        username = EXCLUDED.username,
-                        title = EXCLUDED.title,
-                        users_count = EXCLUDED.users_count,
-                        peer_type = EXCLUDED.peer_type,
-                        data = EXCLUDED.data,
-                        full_chat_data = EXCLUDED.full_chat_data;
-                ''', (
-                    user['id'], user['title'], user['username'], user['peer_type'], user['data'], user['users_count']))
-            self.conn.commit()
-
-    def store_full_chat_data(self, peer_id, full_chat_data):
-        with self.conn.cursor() as cursor:
-            cursor.execute('''
-                UPDATE peer SET full_chat_data = %s WHERE id = %s;
-            ''', (full_chat_data, peer_id))
-            self.conn.commit()
+        """Upserts peers in one statement. full_chat_data, full_chat_data_raw and users_count are optional,
+        stored values are kept when a peer comes without them."""
+        rows = [(peer['id'], peer['title'], peer['username'], peer['peer_type'], peer['data'], peer.get('data_raw'),
+                 peer.get('users_count'), peer.get('full_chat_data'), peer.get('full_chat_data_raw'))
+                for peer in peers]
+        if not rows:
+            return
+        with self._connection() as conn, conn.cursor() as cursor:
+            execute_values(cursor, '''
+                INSERT INTO peer (id, title, username, peer_type, data, data_raw, users_count, full_chat_data,
+                                  full_chat_data_raw)
+                VALUES %s
+                ON CONFLICT (id) DO UPDATE SET
+                    username = EXCLUDED.username,
+                    title = EXCLUDED.title,
+                    users_count = COALESCE(EXCLUDED.users_count, peer.users_count),
+                    peer_type = EXCLUDED.peer_type,
+                    data = EXCLUDED.data,
+                    data_raw = COALESCE(EXCLUDED.data_raw, peer.data_raw),
+                    full_chat_data = COALESCE(EXCLUDED.full_chat_data, peer.full_chat_data),
+                    full_chat_data_raw = COALESCE(EXCLUDED.full_chat_data_raw, peer.full_chat_data_raw);
+            ''', rows, page_size=len(rows))
+            without_count = [peer['id'] for peer in peers if peer.get('users_count') is None]
+            if without_count:
+                # the NULL inserted for new peers without a count skips the column default
+                cursor.execute('UPDATE peer SET users_count = 0 WHERE id = ANY(%s) AND users_count IS NULL;',
+                               (without_count,))
+
+    def store_full_chat_data(self, peer_id, full_chat_data, full_chat_data_raw=None):
+        with self._connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                UPDATE peer SET full_chat_data = %s, full_chat_data_raw = %s WHERE id = %s;
+            ''', (full_chat_data, full_chat_data_raw, peer_id))
 
     def store_users_count(self, peer_id, users_count):
-        with self.conn.cursor() as cursor:
+        with self._connection() as conn, conn.cursor() as cursor:
             cursor.execute('''
                 UPDATE peer SET users_count = %s WHERE id = %s;
             ''', (users_count, peer_id))
-            self.conn.commit()
 
-    def store_user_dialog(self, dialog_id, user_id):
-        with self.conn.cursor() as cursor:
+    def store_user_dialog(self, dialog_id, user_id, config_hash=None, from_date=None, to_date=None):
+        """Registers the dialog, progress and watermark are reset when config_hash differs from the stored one or
+        from_date moves earlier than the scanned range. Returns the dialog state (processed, last_message_id,
+        scanned_message_id, scanned_top_message) after the upsert."""
+        same_scan = ('user_dialog.config_hash IS NOT DISTINCT FROM EXCLUDED.config_hash '
+                     'AND user_dialog.scan_from_date <= EXCLUDED.scan_from_date')
+        with self._connection() as conn, conn.cursor() as cursor:
+            cursor.execute(f'''
+                INSERT INTO user_dialog (user_id, dialog_id, config_hash, scan_from_date, scan_to_date)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (dialog_id, user_id) DO UPDATE SET
+                    processed = coalesce(user_dialog.processed AND {same_scan}
+                        AND user_dialog.scan_to_date >= EXCLUDED.scan_to_date, false),
+                    last_message_id = CASE WHEN {same_scan} THEN user_dialog.last_message_id END,
+                    scanned_message_id = CASE WHEN {same_scan} THEN user_dialog.scanned_message_id END,
+                    scanned_top_message = CASE WHEN {same_scan} THEN user_dialog.scanned_top_message END,
+                    scan_from_date = CASE WHEN {same_scan} THEN user_dialog.scan_from_date
+                        ELSE EXCLUDED.scan_from_date END,
+                    scan_to_date = EXCLUDED.scan_to_date,
+                    config_hash = EXCLUDED.config_hash
+                RETURNING processed, last_message_id, scanned_message_id, scanned_top_message;
+            ''', (user_id, dialog_id, config_hash, from_date, to_date))
+            return cursor.fetchone()
+
+    def store_dialog_checkpoint(self, dialog_id, user_id, last_message_id, scan_data_version=None):
+        with self._connection() as conn, conn.cursor() as cursor:
             cursor.execute('''
-                INSERT INTO user_dialog (user_id, dialog_id) VALUES (%s, %s) ON CONFLICT DO NOTHING;
-            ''', (user_id, dialog_id))
-            self.conn.commit()
+                update user_dialog set last_message_id = %s, scan_data_version = coalesce(%s, scan_data_version)
+                where dialog_id = %s and user_id = %s;
+            ''', (last_message_id, scan_data_version, dialog_id, user_id))
+
+    def get_dialog_checkpoint(self, dialog_id, user_id):
+        with self._connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT last_message_id FROM user_dialog WHERE dialog_id = %s and user_id = %s;
+            ''', (dialog_id, user_id))
+            row = cursor.fetchone()
+            return row[0] if row else None
 
     def mark_dialog_processed(self, dialog_id, user_id):
-        with self.conn.cursor() as cursor:
+        with self._connection() as conn, conn.cursor() as cursor:
             cursor.execute('''
                 update user_dialog set processed = true where dialog_id = %s and user_id = %s;
             ''', (dialog_id, user_id))
-            self.conn.commit()
 
     def get_is_dialog_processed(self, dialog_id, user_id):
-        with self.conn.cursor() as cursor:
+        with self._connection() as conn, conn.cursor() as cursor:
             cursor.execute('''
                 SELECT count(*) FROM user_dialog WHERE dialog_id = %s and user_id = %s and processed = true;
             ''', (dialog_id, user_id))
             return cursor.fetchone()[0] == 1
 
-    def mark_message_deleted(self, message_id, dialog_id):
-        with self.conn.cursor() as cursor:
+    def store_dialog_watermark(self, dialog_id, user_id, scanned_message_id, scanned_top_message):
+        with self._connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                update user_dialog set scanned_message_id = %s, scanned_top_message = %s
+                where dialog_id = %s and user_id = %s;
+            ''', (scanned_message_id, scanned_top_message, dialog_id, user_id))
+
+    def finish_user_dialog(self, dialog_id, user_id, scanned_message_id, scanned_top_message, scan_data_version=None):
+        """Marks the dialog processed and stores the watermark of the finished scan."""
+        with self._connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                update user_dialog set processed = true, scanned_message_id = %s, scanned_top_message = %s,
+                    scan_data_version = coalesce(%s, scan_data_version)
+                where dialog_id = %s and user_id = %s;
+            ''', (scanned_message_id, scanned_top_message, scan_data_version, dialog_id, user_id))
+
+    def get_dialog_watermark(self, dialog_id, user_id):
+        """Returns (scanned_message_id, scanned_top_message) of the last complete scan of the dialog."""
+        with self._connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT scanned_message_id, scanned_top_message FROM user_dialog WHERE dialog_id = %s and user_id = %s;
+            ''', (dialog_id, user_id))
+            row = cursor.fetchone()
+            return (row[0], row[1]) if row else (None, None)
+
+    def mark_messages_deleted(self, pairs):
+        """Marks cached messages deleted by (message_id, dialog_id) pairs with one statement."""
+        if not pairs:
+            return
+        message_ids, dialog_ids = zip(*pairs)
+        with self._connection() as conn, conn.cursor() as cursor:
             cursor.execute('''
-                UPDATE message SET deleted = true WHERE id = %s and dialog_id = %s;
-            ''', (message_id, dialog_id,))
-            self.conn.commit()
+                UPDATE message SET deleted = true
+                FROM unnest(%s::BIGINT[], %s::BIGINT[]) AS deleted_message (id, dialog_id)
+                WHERE message.id = deleted_message.id AND message.dialog_id = deleted_message.dialog_id;
+            ''', (list(message_ids), list(dialog_ids)))
 
     def search_peer(self, id):
-        with self.conn.cursor() as cursor:
+        with self._connection() as conn, conn.cursor() as cursor:
             cursor.execute('''
                 SELECT * FROM peer WHERE id = %s;
             ''', (id,))
             return cursor.fetchone()
 
     def search_messages(self, query, field="dialog_name"):
-        with self.conn.cursor() as cursor:
+        with self._connection() as conn, conn.cursor() as cursor:
             cursor.execute(sql.SQL('''
                 SELECT * FROM message WHERE {} ILIKE %s;
-            ''').format(sql.Identifier(field)), (f'%{query}%',))
+            ''').format(sql.Identifier(field)), (f'%{like_escape(query)}%',))
             return cursor.fetchall()
 
-    def count_messages(self, user_id):
-        with self.conn.cursor() as cursor:
+    def search_message_text(self, query, user_id=None, include_deleted=False, limit=100):
+        """Case-insensitive substring search over cached message texts, served by the trigram index
+        for queries of 3+ characters."""
+        with self._connection() as conn, conn.cursor() as cursor:
             cursor.execute('''
-                SELECT count(*) FROM message WHERE user_id = %s and deleted = false;
-            ''', (user_id,))
+                SELECT user_id, dialog_id, dialog_name, message_text, message
+                FROM message
+                WHERE message_text ILIKE %s
+                  AND (%s::BIGINT IS NULL OR user_id = %s)
+                  AND (%s OR NOT deleted)
+                LIMIT %s;
+            ''', (f'%{like_escape(query)}%', user_id, user_id, include_deleted, limit))
+            return [TgMessage(user_id=row[0], dialog_id=row[1], dialog_name=row[2], message_text=row[3],
+                              message=row[4]) for row in cursor.fetchall()]
+
+    def count_messages(self, user_id, from_date=None, to_date=None):
+        with self._connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT count(*) FROM message WHERE user_id = %s AND NOT deleted
+                  AND message_date >= COALESCE(%s::TIMESTAMPTZ, '-infinity') AND message_date <= COALESCE(%s::TIMESTAMPTZ, 'infinity');
+            ''', (user_id, from_date, to_date))
             return cursor.fetchone()[0]
 
 
-    def load_messages_in_batches(self, user_id, batch_size=1000) -> list[TgMessage]:
-        with self.conn.cursor(name='message_cursor') as cursor:
+    def load_messages_in_batches(self, user_id, batch_size=1000, dialog_ids=None, forwarded_only=False,
+                                 from_date=None, to_date=None, columns=MESSAGE_COLUMNS,
+                                 message_keys=None) -> list[TgMessage]:
+        check_message_columns(columns)
+        selected = []
+        for column in columns:
+            if column != 'message':
+                selected.append(sql.Identifier(column))
+            elif message_keys is None:
+                # selected as text so psycopg2 doesn't decode it, TgMessage decodes it on first access
+                selected.append(sql.SQL('message::text'))
+            else:
+                selected.append(sql.SQL(
+                    '(SELECT jsonb_object_agg(key, value) FROM jsonb_each(message) WHERE key = ANY({}))::text'
+                ).format(sql.Literal(list(message_keys))))
+        with self._connection() as conn, conn.cursor(name='message_cursor') as cursor:
             cursor.itersize = batch_size
-            cursor.execute('''
-            SELECT user_id, dialog_id, dialog_name, message_text, message
+            cursor.execute(sql.SQL('''
+            SELECT {}
             FROM message
-            WHERE user_id = %s AND deleted = false;
-        ''', (user_id,))
+            WHERE user_id = %s AND NOT deleted
+              AND (%s::BIGINT[] IS NULL OR dialog_id = ANY(%s::BIGINT[]))
+              AND (NOT %s OR jsonb_typeof(message->'fwd_from') = 'object')
+              AND message_date >= COALESCE(%s::TIMESTAMPTZ, '-infinity') AND message_date <= COALESCE(%s::TIMESTAMPTZ, 'infinity');
+        ''').format(sql.SQL(', ').join([sql.Identifier('id'), sql.Identifier('dialog_id')] + selected)),
+                (user_id, dialog_ids, dialog_ids, forwarded_only, from_date, to_date))
             for row in cursor:
-                yield TgMessage(user_id=row[0], dialog_id=row[1], dialog_name=row[2], message_text=row[3],
-                                message=row[4])
+                yield TgMessage.from_row(user_id, columns, row)
+
+    def count_messages_by_dialog(self, user_id, from_date=None, to_date=None):
+        """Returns {dialog_id: count} of not deleted cached messages."""
+        with self._connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT dialog_id, count(*) FROM message WHERE user_id = %s AND NOT deleted
+                  AND message_date >= COALESCE(%s::TIMESTAMPTZ, '-infinity') AND message_date <= COALESCE(%s::TIMESTAMPTZ, 'infinity')
+                GROUP BY dialog_id;
+            ''', (user_id, from_date, to_date))
+            return dict(cursor.fetchall())
+
+    def load_peer_names(self):
+        """Returns {peer_id: (username, title)} of cached peers."""
+        with self._connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT id, username, title FROM peer;
+            ''')
+            return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+    def store_deletion_plan(self, user_id, items):
+        """Stores (dialog_id, message_id, reason) items to be deleted by a later online pass."""
+        rows = [(user_id, dialog_id, message_id, reason) for dialog_id, message_id, reason in items]
+        if not rows:
+            return
+        with self._connection() as conn, conn.cursor() as cursor:
+            execute_values(cursor, '''
+                INSERT INTO deletion_plan (user_id, dialog_id, message_id, reason) VALUES %s
+                ON CONFLICT (user_id, dialog_id, message_id) DO UPDATE SET reason = EXCLUDED.reason;
+            ''', rows, page_size=10000)
+
+    def load_deletion_plan(self, user_id):
+        """Returns {dialog_id: [message_id]} of planned deletions not applied yet."""
+        with self._connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT dialog_id, array_agg(message_id ORDER BY message_id) FROM deletion_plan
+                WHERE user_id = %s AND NOT applied GROUP BY dialog_id;
+            ''', (user_id,))
+            return dict(cursor.fetchall())
+
+    def mark_deletion_plan_applied(self, user_id, dialog_id, message_ids):
+        with self._connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                UPDATE deletion_plan SET applied = true
+                WHERE user_id = %s AND dialog_id = %s AND message_id = ANY(%s::BIGINT[]);
+            ''', (user_id, dialog_id, list(message_ids)))
+
+    def find_scan_matches(self, user_id, patterns, dialog_ids=None, from_date=None, to_date=None):
+        """Finds cached messages containing any of the patterns inside the database.
+
+        patterns is a list of (pattern, data, data_type) in check order. Returns (id, dialog_id, data, data_type)
+        for every pattern a message contains, ordered by dialog_id and id, the patterns of a message in check order."""
+        rows = [(ordinal, like_escape(pattern), data, data_type)
+                for ordinal, (pattern, data, data_type) in enumerate(patterns) if pattern]
+        if not rows:
+            return []
+        with self._connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                CREATE TEMP TABLE scan_pattern (ordinal INTEGER, pattern TEXT, data TEXT, data_type TEXT) ON COMMIT DROP;
+            ''')
+            execute_values(cursor, 'INSERT INTO scan_pattern (ordinal, pattern, data, data_type) VALUES %s', rows,
+                           page_size=10000)
+            cursor.execute('ANALYZE scan_pattern;')
+            cursor.execute('''
+                SELECT m.id, m.dialog_id, p.data, p.data_type
+                FROM scan_pattern p
+                JOIN message m ON m.message_text ILIKE '%%' || p.pattern || '%%'
+                WHERE m.user_id = %s AND NOT m.deleted AND (%s::BIGINT[] IS NULL OR m.dialog_id = ANY(%s::BIGINT[]))
+                  AND m.message_date >= COALESCE(%s::TIMESTAMPTZ, '-infinity') AND m.message_date <= COALESCE(%s::TIMESTAMPTZ, 'infinity')
+                ORDER BY m.dialog_id, m.id, p.ordinal;
+            ''', (user_id, dialog_ids, dialog_ids, from_date, to_date))
+            return cursor.fetchall()
 
     def close_connection(self):
-        self.conn.close()
+        self.pool.closeall()
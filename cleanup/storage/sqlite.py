@@ -0,0 +1,434 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import timezone
+
+from cleanup.storage.base import Storage, TgMessage, like_escape, MESSAGE_COLUMNS, check_message_columns
+
+DEFAULT_PATH = ".cache/messages.db"
+
+ALL_MESSAGE_COLUMNS = ('id', 'user_id', 'dialog_id', 'dialog_name', 'message_text', 'message', 'deleted', 'created_at',
+                   'message_date')
+
+# not deleted messages of a user, optionally of the dialogs in a JSON array and in a date range
+MESSAGE_FILTER = '''
+    m.user_id = :user_id AND NOT m.deleted
+    AND (:dialog_ids IS NULL OR m.dialog_id IN (SELECT value FROM json_each(:dialog_ids)))
+    AND (:from_date IS NULL OR m.message_date >= :from_date) AND (:to_date IS NULL OR m.message_date <= :to_date)
+'''
+
+
+def _timestamp(date):
+    """UTC timestamp text, compares in date order."""
+    return date.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f') if date else None
+
+
+def _message_filter_params(user_id, dialog_ids=None, from_date=None, to_date=None):
+    return {'user_id': user_id, 'dialog_ids': json.dumps(list(dialog_ids)) if dialog_ids is not None else None,
+            'from_date': _timestamp(from_date), 'to_date': _timestamp(to_date)}
+
+
+def _fts_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _lower(text):
+    return text.lower() if text is not None else None
+
+
+class SqliteStorage(Storage):
+    """Cache in a local SQLite file, for runs without a Postgres server.
+
+    Uses WAL so offline scan processes read while the scanner writes, every call is one transaction and
+    message texts are indexed with FTS5 (trigram tokenizer) for substring searches."""
+
+    def __init__(self, path=DEFAULT_PATH, migrate=True):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # one connection per thread, sqlite3 connections can't be shared between threads
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        if migrate:
+            self._initialize_tables()
+
+    @classmethod
+    def from_config(cls, storage_config):
+        return cls(path=storage_config.path)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode = WAL;')
+            conn.execute('PRAGMA synchronous = NORMAL;')
+            conn.create_function('py_lower', 1, _lower, deterministic=True)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        """Thread's connection in a transaction, committed on success and rolled back on error."""
+        conn = self._connect()
+        with conn:
+            yield conn
+
+    def _initialize_tables(self):
+        self._connect().executescript('''
+            CREATE TABLE IF NOT EXISTS peer (
+                id INTEGER PRIMARY KEY,
+                title TEXT,
+                username TEXT,
+                peer_type TEXT,
+                users_count INTEGER DEFAULT 0,
+                data TEXT,
+                data_raw BLOB,
+                full_chat_data TEXT,
+                full_chat_data_raw BLOB,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            );
+
+            CREATE TABLE IF NOT EXISTS user_dialog (
+                dialog_id INTEGER,
+                user_id INTEGER,
+                processed INTEGER DEFAULT 0,
+                config_hash TEXT,
+                last_message_id INTEGER,
+                scanned_message_id INTEGER,
+                scanned_top_message INTEGER,
+                scan_data_version TEXT,
+                scan_from_date TEXT,
+                scan_to_date TEXT,
+                PRIMARY KEY (dialog_id, user_id)
+            );
+
+            CREATE TABLE IF NOT EXISTS deletion_plan (
+                user_id INTEGER,
+                dialog_id INTEGER,
+                message_id INTEGER,
+                reason TEXT,
+                applied INTEGER DEFAULT 0,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, dialog_id, message_id)
+            );
+
+            CREATE TABLE IF NOT EXISTS message (
+                id INTEGER,
+                user_id INTEGER,
+                dialog_id INTEGER,
+                dialog_name TEXT,
+                message_text TEXT,
+                message TEXT,
+                message_raw BLOB,
+                deleted INTEGER DEFAULT 0,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                message_date TEXT NOT NULL,
+                PRIMARY KEY (id, dialog_id)
+            );
+            CREATE INDEX IF NOT EXISTS message_user_id_date_idx ON message (user_id, message_date) WHERE NOT deleted;
+
+            CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+                message_text, content='message', content_rowid='rowid', tokenize='trigram'
+            );
+            CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message BEGIN
+                INSERT INTO message_fts (rowid, message_text) VALUES (new.rowid, new.message_text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN
+                INSERT INTO message_fts (message_fts, rowid, message_text) VALUES ('delete', old.rowid, old.message_text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE OF message_text ON message BEGIN
+                INSERT INTO message_fts (message_fts, rowid, message_text) VALUES ('delete', old.rowid, old.message_text);
+                INSERT INTO message_fts (rowid, message_text) VALUES (new.rowid, new.message_text);
+            END;
+        ''')
+        columns = {row[1] for row in self._connect().execute('PRAGMA table_info(user_dialog);')}
+        for column in ('scan_data_version', 'scan_from_date', 'scan_to_date'):
+            if column not in columns:
+                self._connect().execute(f'ALTER TABLE user_dialog ADD COLUMN {column} TEXT;')
+
+    def store_messages(self, messages):
+        rows = [(message['id'], message['user_id'], message['dialog_id'], message['dialog_name'], message['message'],
+                 message['message_text'], message.get('deleted', False), _timestamp(message['message_date']),
+                 message.get('message_raw'))
+                for message in messages]
+        if not rows:
+            return
+        with self._connection() as conn:
+            conn.executemany('''
+                INSERT INTO message (id, user_id, dialog_id, dialog_name, message, message_text, deleted, message_date,
+                                     message_raw)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id, dialog_id) DO UPDATE SET
+                    user_id = excluded.user_id,
+                    dialog_name = excluded.dialog_name,
+                    message_text = excluded.message_text,
+                    message = excluded.message,
+                    message_raw = COALESCE(excluded.message_raw, message.message_raw),
+                    deleted = excluded.deleted,
+                    message_date = excluded.message_date;
+            ''', rows)
+
+    def store_peer(self, peers):
+        """Upserts peers in one transaction. full_chat_data, full_chat_data_raw and users_count are optional,
+        stored values are kept when a peer comes without them."""
+        rows = [(peer['id'], peer['title'], peer['username'], peer['peer_type'], peer['data'], peer.get('data_raw'),
+                 peer.get('users_count'), peer.get('full_chat_data'), peer.get('full_chat_data_raw'))
+                for peer in peers]
+        if not rows:
+            return
+        with self._connection() as conn:
+            conn.executemany('''
+                INSERT INTO peer (id, title, username, peer_type, data, data_raw, users_count, full_chat_data,
+                                  full_chat_data_raw)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    username = excluded.username,
+                    title = excluded.title,
+                    users_count = COALESCE(excluded.users_count, peer.users_count),
+                    peer_type = excluded.peer_type,
+                    data = excluded.data,
+                    data_raw = COALESCE(excluded.data_raw, peer.data_raw),
+                    full_chat_data = COALESCE(excluded.full_chat_data, peer.full_chat_data),
+                    full_chat_data_raw = COALESCE(excluded.full_chat_data_raw, peer.full_chat_data_raw);
+            ''', rows)
+            without_count = [peer['id'] for peer in peers if peer.get('users_count') is None]
+            if without_count:
+                # the NULL inserted for new peers without a count skips the column default
+                conn.execute('UPDATE peer SET users_count = 0 '
+                             'WHERE id IN (SELECT value FROM json_each(?)) AND users_count IS NULL;',
+                             (json.dumps(without_count),))
+
+    def store_full_chat_data(self, peer_id, full_chat_data, full_chat_data_raw=None):
+        with self._connection() as conn:
+            conn.execute('''
+                UPDATE peer SET full_chat_data = ?, full_chat_data_raw = ? WHERE id = ?;
+            ''', (full_chat_data, full_chat_data_raw, peer_id))
+
+    def store_users_count(self, peer_id, users_count):
+        with self._connection() as conn:
+            conn.execute('UPDATE peer SET users_count = ? WHERE id = ?;', (users_count, peer_id))
+
+    def store_user_dialog(self, dialog_id, user_id, config_hash=None, from_date=None, to_date=None):
+        same_scan = ('user_dialog.config_hash IS excluded.config_hash '
+                     'AND user_dialog.scan_from_date <= excluded.scan_from_date')
+        with self._connection() as conn:
+            row = conn.execute(f'''
+                INSERT INTO user_dialog (user_id, dialog_id, config_hash, scan_from_date, scan_to_date)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (dialog_id, user_id) DO UPDATE SET
+                    processed = coalesce(user_dialog.processed AND {same_scan}
+                        AND user_dialog.scan_to_date >= excluded.scan_to_date, 0),
+                    last_message_id = CASE WHEN {same_scan} THEN user_dialog.last_message_id END,
+                    scanned_message_id = CASE WHEN {same_scan} THEN user_dialog.scanned_message_id END,
+                    scanned_top_message = CASE WHEN {same_scan} THEN user_dialog.scanned_top_message END,
+                    scan_from_date = CASE WHEN {same_scan} THEN user_dialog.scan_from_date
+                        ELSE excluded.scan_from_date END,
+                    scan_to_date = excluded.scan_to_date,
+                    config_hash = excluded.config_hash
+                RETURNING processed, last_message_id, scanned_message_id, scanned_top_message;
+            ''', (user_id, dialog_id, config_hash, _timestamp(from_date), _timestamp(to_date))).fetchone()
+            return bool(row[0]), row[1], row[2], row[3]
+
+    def store_dialog_checkpoint(self, dialog_id, user_id, last_message_id, scan_data_version=None):
+        with self._connection() as conn:
+            conn.execute('''
+                UPDATE user_dialog SET last_message_id = ?, scan_data_version = coalesce(?, scan_data_version)
+                WHERE dialog_id = ? AND user_id = ?;
+            ''', (last_message_id, scan_data_version, dialog_id, user_id))
+
+    def get_dialog_checkpoint(self, dialog_id, user_id):
+        with self._connection() as conn:
+            row = conn.execute('''
+                SELECT last_message_id FROM user_dialog WHERE dialog_id = ? AND user_id = ?;
+            ''', (dialog_id, user_id)).fetchone()
+            return row[0] if row else None
+
+    def mark_dialog_processed(self, dialog_id, user_id):
+        with self._connection() as conn:
+            conn.execute('''
+                UPDATE user_dialog SET processed = 1 WHERE dialog_id = ? AND user_id = ?;
+            ''', (dialog_id, user_id))
+
+    def get_is_dialog_processed(self, dialog_id, user_id):
+        with self._connection() as conn:
+            row = conn.execute('''
+                SELECT processed FROM user_dialog WHERE dialog_id = ? AND user_id = ?;
+            ''', (dialog_id, user_id)).fetchone()
+            return bool(row and row[0])
+
+    def store_dialog_watermark(self, dialog_id, user_id, scanned_message_id, scanned_top_message):
+        with self._connection() as conn:
+            conn.execute('''
+                UPDATE user_dialog SET scanned_message_id = ?, scanned_top_message = ? WHERE dialog_id = ? AND user_id = ?;
+            ''', (scanned_message_id, scanned_top_message, dialog_id, user_id))
+
+    def finish_user_dialog(self, dialog_id, user_id, scanned_message_id, scanned_top_message, scan_data_version=None):
+        with self._connection() as conn:
+            conn.execute('''
+                UPDATE user_dialog SET processed = 1, scanned_message_id = ?, scanned_top_message = ?,
+                    scan_data_version = coalesce(?, scan_data_version)
+                WHERE dialog_id = ? AND user_id = ?;
+            ''', (scanned_message_id, scanned_top_message, scan_data_version, dialog_id, user_id))
+
+    def get_dialog_watermark(self, dialog_id, user_id):
+        with self._connection() as conn:
+            row = conn.execute('''
+                SELECT scanned_message_id, scanned_top_message FROM user_dialog WHERE dialog_id = ? AND user_id = ?;
+            ''', (dialog_id, user_id)).fetchone()
+            return (row[0], row[1]) if row else (None, None)
+
+    def mark_messages_deleted(self, pairs):
+        if not pairs:
+            return
+        with self._connection() as conn:
+            conn.executemany('UPDATE message SET deleted = 1 WHERE id = ? AND dialog_id = ?;', pairs)
+
+    def search_peer(self, id):
+        with self._connection() as conn:
+            return conn.execute('SELECT * FROM peer WHERE id = ?;', (id,)).fetchone()
+
+    def search_messages(self, query, field="dialog_name"):
+        if field not in ALL_MESSAGE_COLUMNS:
+            raise ValueError(f"Unknown message field: {field}")
+        with self._connection() as conn:
+            return conn.execute(f'''
+                SELECT * FROM message WHERE "{field}" LIKE ? ESCAPE '\\';
+            ''', (f'%{like_escape(query)}%',)).fetchall()
+
+    def search_message_text(self, query, user_id=None, include_deleted=False, limit=100):
+        """Case-insensitive substring search over cached message texts, served by the FTS5 trigram index
+        for queries of 3+ characters."""
+        if len(query) >= 3:
+            text_condition = 'rowid IN (SELECT rowid FROM message_fts WHERE message_fts MATCH ?)'
+            text_param = _fts_phrase(query)
+        else:
+            text_condition = 'instr(py_lower(message_text), ?) > 0'
+            text_param = query.lower()
+        with self._connection() as conn:
+            rows = conn.execute(f'''
+                SELECT user_id, dialog_id, dialog_name, message_text, message
+                FROM message
+                WHERE {text_condition}
+                  AND (? IS NULL OR user_id = ?)
+                  AND (? OR NOT deleted)
+                LIMIT ?;
+            ''', (text_param, user_id, user_id, include_deleted, limit)).fetchall()
+            return [TgMessage(user_id=row[0], dialog_id=row[1], dialog_name=row[2], message_text=row[3],
+                              message_json=row[4]) for row in rows]
+
+    def count_messages(self, user_id, from_date=None, to_date=None):
+        with self._connection() as conn:
+            return conn.execute(f'SELECT count(*) FROM message m WHERE {MESSAGE_FILTER};',
+                                _message_filter_params(user_id, from_date=from_date, to_date=to_date)).fetchone()[0]
+
+    def load_messages_in_batches(self, user_id, batch_size=1000, dialog_ids=None, forwarded_only=False,
+                                 from_date=None, to_date=None, columns=MESSAGE_COLUMNS,
+                                 message_keys=None) -> list[TgMessage]:
+        check_message_columns(columns)
+        params = _message_filter_params(user_id, dialog_ids, from_date, to_date)
+        params['forwarded_only'] = forwarded_only
+        selected = ['m.id', 'm.dialog_id']
+        for column in columns:
+            if column != 'message' or message_keys is None:
+                selected.append(f'm.{column}')
+            else:
+                selected.append('(SELECT json_group_object(key, value) FROM json_each(m.message) '
+                                'WHERE key IN (SELECT value FROM json_each(:message_keys)))')
+                params['message_keys'] = json.dumps(list(message_keys))
+        cursor = self._connect().execute(f'''
+            SELECT {', '.join(selected)}
+            FROM message m
+            WHERE {MESSAGE_FILTER}
+              AND (NOT :forwarded_only OR json_type(m.message, '$.fwd_from') = 'object');
+        ''', params)
+        try:
+            while rows := cursor.fetchmany(batch_size):
+                for row in rows:
+                    yield TgMessage.from_row(user_id, columns, row)
+        finally:
+            cursor.close()
+
+    def count_messages_by_dialog(self, user_id, from_date=None, to_date=None):
+        with self._connection() as conn:
+            return dict(conn.execute(f'SELECT m.dialog_id, count(*) FROM message m WHERE {MESSAGE_FILTER} GROUP BY m.dialog_id;',
+                                     _message_filter_params(user_id, from_date=from_date, to_date=to_date)).fetchall())
+
+    def load_peer_names(self):
+        with self._connection() as conn:
+            return {row[0]: (row[1], row[2]) for row in conn.execute('SELECT id, username, title FROM peer;')}
+
+    def store_deletion_plan(self, user_id, items):
+        rows = [(user_id, dialog_id, message_id, reason) for dialog_id, message_id, reason in items]
+        if not rows:
+            return
+        with self._connection() as conn:
+            conn.executemany('''
+                INSERT INTO deletion_plan (user_id, dialog_id, message_id, reason) VALUES (?, ?, ?, ?)
+                ON CONFLICT (user_id, dialog_id, message_id) DO UPDATE SET reason = excluded.reason;
+            ''', rows)
+
+    def load_deletion_plan(self, user_id):
+        plan = {}
+        with self._connection() as conn:
+            for dialog_id, message_id in conn.execute('''
+                SELECT dialog_id, message_id FROM deletion_plan WHERE user_id = ? AND NOT applied
+                ORDER BY dialog_id, message_id;
+            ''', (user_id,)):
+                plan.setdefault(dialog_id, []).append(message_id)
+        return plan
+
+    def mark_deletion_plan_applied(self, user_id, dialog_id, message_ids):
+        with self._connection() as conn:
+            conn.executemany('''
+                UPDATE deletion_plan SET applied = 1 WHERE user_id = ? AND dialog_id = ? AND message_id = ?;
+            ''', [(user_id, dialog_id, message_id) for message_id in message_ids])
+
+    def find_scan_matches(self, user_id, patterns, dialog_ids=None, from_date=None, to_date=None):
+        """Patterns of 3+ characters are looked up in the FTS5 trigram index, shorter ones are searched for
+        in every message of the range."""
+        rows = [(ordinal, pattern.lower(), _fts_phrase(pattern), data, data_type)
+                for ordinal, (pattern, data, data_type) in enumerate(patterns) if pattern]
+        if not rows:
+            return []
+        hits = '''
+            SELECT f.rowid AS message_rowid, p.ordinal FROM scan_pattern p
+            JOIN message_fts f ON message_fts MATCH p.query
+            WHERE length(p.pattern) >= 3
+        '''
+        if any(len(row[1]) < 3 for row in rows):
+            hits += '''
+                UNION ALL
+                SELECT m.rowid, p.ordinal FROM scan_pattern p
+                JOIN message m ON instr(py_lower(m.message_text), p.pattern) > 0
+                WHERE length(p.pattern) < 3
+            '''
+        with self._connection() as conn:
+            conn.execute('''
+                CREATE TEMP TABLE IF NOT EXISTS scan_pattern (
+                    ordinal INTEGER PRIMARY KEY, pattern TEXT, query TEXT, data TEXT, data_type TEXT
+                );
+            ''')
+            conn.execute('DELETE FROM scan_pattern;')
+            conn.executemany('INSERT INTO scan_pattern (ordinal, pattern, query, data, data_type) VALUES (?, ?, ?, ?, ?)',
+                             rows)
+            return conn.execute(f'''
+                WITH hit AS ({hits})
+                SELECT m.id, m.dialog_id, p.data, p.data_type
+                FROM hit
+                JOIN message m ON m.rowid = hit.message_rowid
+                JOIN scan_pattern p ON p.ordinal = hit.ordinal
+                WHERE {MESSAGE_FILTER}
+                ORDER BY m.dialog_id, m.id, hit.ordinal;
+            ''', _message_filter_params(user_id, dialog_ids, from_date, to_date)).fetchall()
+
+    def close_connection(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
@@ -0,0 +1,100 @@
+"""Compares ScanDataMatcher against the substring loop it replaced in TelegramScanner.check_message_text.
+
+Usage: python scripts/bench_matcher.py [pattern counts...]
+"""
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from cleanup.config.scan_config import Config
+from cleanup.docextract.scan_data import ScanData, ScanDataEntry, ScanDataType
+from cleanup.docextract.scan_matcher import ScanDataMatcher
+
+PATTERN_TYPES = [ScanDataType.TG_USERNAME, ScanDataType.TG_USER_NAME, ScanDataType.TG_KEYWORD, ScanDataType.TG_URL,
+                 ScanDataType.INSTAGRAM_USERNAME]
+WORDS = ["привет", "hello", "как", "дела", "see", "link", "the", "channel", "news", "today", "это", "фото", "video"]
+
+
+def random_word(rnd, min_len=5, max_len=14):
+    return "".join(rnd.choice(string.ascii_lowercase + string.digits + "_") for _ in range(rnd.randint(min_len, max_len)))
+
+
+def make_scan_data(count, rnd):
+    scan_data = ScanData(Config())
+    scan_data.data_by_type = {data_type: [] for data_type in ScanDataType}
+    for i in range(count):
+        data_type = PATTERN_TYPES[i % len(PATTERN_TYPES)]
+        data = random_word(rnd)
+        if data_type == ScanDataType.TG_URL:
+            data += ".com"
+        entry = ScanDataEntry(data, data_type)
+        scan_data.data.append(entry)
+        scan_data.data_by_type[data_type].append(entry)
+    return scan_data
+
+
+def make_messages(scan_data, count, rnd, hit_ratio=0.05):
+    usernames = scan_data.data_by_type[ScanDataType.TG_USERNAME]
+    messages = []
+    for _ in range(count):
+        words = [rnd.choice(WORDS) for _ in range(rnd.randint(5, 40))]
+        if usernames and rnd.random() < hit_ratio:
+            words.insert(rnd.randrange(len(words)), "@" + rnd.choice(usernames).data)
+        messages.append(" ".join(words))
+    return messages
+
+
+def loop_find(scan_data, text):
+    found = []
+    for entry in scan_data.data_by_type[ScanDataType.TG_USERNAME] + scan_data.data_by_type[ScanDataType.TG_USER_NAME]:
+        if "@" + entry.data in text or "t.me/" + entry.data in text:
+            found.append(entry)
+    for entry in scan_data.data_by_type[ScanDataType.INSTAGRAM_NAME] + scan_data.data_by_type[ScanDataType.INSTAGRAM_USERNAME]:
+        if "instagram.com/" + entry.data in text:
+            found.append(entry)
+    for entry in scan_data.data_by_type[ScanDataType.TG_KEYWORD]:
+        if entry.data in text:
+            found.append(entry)
+    for entry in scan_data.data_by_type[ScanDataType.TG_URL]:
+        if entry.data in text:
+            found.append(entry)
+    return found
+
+
+def messages_per_second(find, messages, budget=3.0):
+    processed = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < budget:
+        for message in messages:
+            find(message)
+            processed += 1
+            if processed % 50 == 0 and time.perf_counter() - start >= budget:
+                break
+    return processed / (time.perf_counter() - start)
+
+
+def main(counts):
+    rnd = random.Random(42)
+    print(f"{'patterns':>10} {'build, s':>10} {'loop msg/s':>12} {'matcher msg/s':>14} {'speedup':>8}")
+    for count in counts:
+        scan_data = make_scan_data(count, rnd)
+        messages = make_messages(scan_data, 2000, rnd)
+
+        start = time.perf_counter()
+        matcher = ScanDataMatcher(scan_data)
+        build_time = time.perf_counter() - start
+
+        for message in messages[:200]:
+            assert matcher.find(message) == loop_find(scan_data, message)
+
+        loop_rate = messages_per_second(lambda text: loop_find(scan_data, text), messages)
+        matcher_rate = messages_per_second(matcher.find, messages)
+        print(f"{count:>10} {build_time:>10.2f} {loop_rate:>12.0f} {matcher_rate:>14.0f} {matcher_rate / loop_rate:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000])
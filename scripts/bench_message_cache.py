@@ -0,0 +1,80 @@
+"""Compares the compact message cache format against Telethon's to_json, the format cached before it.
+
+Measures serialization time per message and the size of the JSON stored in the message column, plus the
+compressed full JSON kept with cache_full_json.
+
+Usage: python scripts/bench_message_cache.py [message count]
+"""
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from telethon.tl import types
+
+from cleanup.message_checks import cached_message_text
+from cleanup.storage.compact import compact_message, compact_message_dict, compress_json
+
+WORDS = ["привет", "hello", "как", "дела", "see", "link", "the", "channel", "news", "today", "это", "фото", "video"]
+
+
+def make_message(i, rnd):
+    text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(5, 60)))
+    entities = [types.MessageEntityBold(offset=0, length=5)]
+    media = None
+    fwd_from = None
+    if rnd.random() < 0.3:
+        entities.append(types.MessageEntityTextUrl(offset=6, length=4, url=f"https://example.com/{i}"))
+    if rnd.random() < 0.2:
+        media = types.MessageMediaWebPage(webpage=types.WebPage(
+            id=i, url=f"https://news.example.com/{i}", display_url=f"news.example.com/{i}", hash=0,
+            type="article", site_name="Example", title="Title " + text[:40], description=text))
+    if rnd.random() < 0.2:
+        fwd_from = types.MessageFwdHeader(date=datetime.now(timezone.utc), from_id=types.PeerChannel(channel_id=i),
+                                          channel_post=i)
+    return types.Message(
+        id=i, peer_id=types.PeerChannel(channel_id=1), date=datetime.now(timezone.utc) - timedelta(minutes=i),
+        message=text, from_id=types.PeerUser(user_id=rnd.randint(1, 10 ** 9)), entities=entities, media=media,
+        fwd_from=fwd_from, views=rnd.randint(0, 10 ** 5), forwards=rnd.randint(0, 100),
+        reply_to=types.MessageReplyHeader(reply_to_msg_id=i - 1) if rnd.random() < 0.3 else None,
+        reactions=types.MessageReactions(results=[
+            types.ReactionCount(reaction=types.ReactionEmoji(emoticon="👍"), count=rnd.randint(1, 50))]),
+    )
+
+
+def measure(serialize, messages):
+    start = time.perf_counter()
+    sizes = [len(serialize(message) or b'') for message in messages]
+    elapsed = time.perf_counter() - start
+    return elapsed / len(messages) * 1e6, sum(sizes) / len(sizes)
+
+
+def main(count):
+    rnd = random.Random(42)
+    messages = [make_message(i, rnd) for i in range(1, count + 1)]
+
+    # the compact format must keep everything the checks read
+    for message in messages:
+        full = message.to_dict()
+        compact = compact_message_dict(message)
+        assert cached_message_text(message.message, compact) == \
+            cached_message_text(message.message, full)
+        assert bool(compact.get('fwd_from')) == bool(full.get('fwd_from'))
+
+    results = {
+        "to_json": measure(lambda message: message.to_json(ensure_ascii=False).encode(), messages),
+        "compact": measure(lambda message: compact_message(message).encode(), messages),
+        "full, zlib": measure(compress_json, messages),
+    }
+    base_time, base_size = results["to_json"]
+    print(f"{'format':>12} {'us/message':>11} {'bytes':>8} {'cpu':>7} {'size':>7}")
+    for name, (time_per_message, size) in results.items():
+        print(f"{name:>12} {time_per_message:>11.1f} {size:>8.0f} {base_time / time_per_message:>6.1f}x "
+              f"{base_size / size:>6.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,103 @@
+"""Compares loading cached messages for the offline scan with and without column/JSON projection.
+
+"full" loads every column and decodes the whole message JSON into a dict per row, as load_messages_in_batches did
+before; "projected" loads the columns and JSON keys the checks read, decoded on access. Runs against a temporary
+SQLite cache filled with messages in the full cache format.
+
+Usage: python scripts/bench_message_loading.py [message count]
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from cleanup.message_checks import CHECKED_MESSAGE_KEYS, cached_message_text
+from cleanup.storage.sqlite import SqliteStorage
+
+WORDS = ["привет", "hello", "как", "дела", "see", "link", "the", "channel", "news", "today", "это", "фото", "video"]
+
+
+class DictMessage:
+    """Row object as it was before: instance dict and the decoded JSON."""
+
+    def __init__(self, user_id, dialog_id, dialog_name, message_text, message, id=None):
+        self.id = id
+        self.user_id = user_id
+        self.dialog_id = dialog_id
+        self.dialog_name = dialog_name
+        self.message_text = message_text
+        self.message = message
+
+
+def make_row(i, rnd, now):
+    text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(5, 60)))
+    message = {'_': 'Message', 'id': i, 'date': (now - timedelta(minutes=i)).isoformat(), 'message': text,
+               'out': True, 'mentioned': False, 'media_unread': False, 'silent': False, 'post': False,
+               'peer_id': {'_': 'PeerChannel', 'channel_id': 1}, 'from_id': {'_': 'PeerUser', 'user_id': i % 1000},
+               'views': rnd.randint(0, 10 ** 5), 'forwards': rnd.randint(0, 100), 'replies': None,
+               'reactions': {'_': 'MessageReactions', 'results': [
+                   {'_': 'ReactionCount', 'reaction': {'_': 'ReactionEmoji', 'emoticon': '👍'}, 'count': 3}]},
+               'entities': [{'_': 'MessageEntityBold', 'offset': 0, 'length': 5}], 'media': None, 'fwd_from': None}
+    if rnd.random() < 0.2:
+        message['media'] = {'_': 'MessageMediaWebPage', 'webpage': {
+            '_': 'WebPage', 'id': i, 'url': f"https://news.example.com/{i}", 'type': 'article',
+            'site_name': 'Example', 'title': text[:40], 'description': text}}
+    return {'id': i, 'user_id': 1, 'dialog_id': i % 50, 'dialog_name': f"Dialog {i % 50}", 'message_text': text,
+            'message': json.dumps(message, ensure_ascii=False), 'message_date': now - timedelta(minutes=i)}
+
+
+def load_full(storage):
+    # every column and the decoded JSON, as the loader did before projection
+    cursor = storage._connect().execute('SELECT user_id, dialog_id, dialog_name, message_text, message, id '
+                                        'FROM message WHERE user_id = 1 AND NOT deleted;')
+    for row in cursor:
+        yield DictMessage(row[0], row[1], row[2], row[3], json.loads(row[4]), row[5])
+
+
+def load_projected(storage):
+    return storage.load_messages_in_batches(1, columns=('message_text', 'message'), message_keys=CHECKED_MESSAGE_KEYS)
+
+
+def load_and_check(load, storage):
+    # rows are kept like a batch of a shard, the checks read the text with link targets
+    messages = list(load(storage))
+    for message in messages:
+        cached_message_text(message.message_text, message.message)
+    return len(messages)
+
+
+def measure(load, storage):
+    start = time.perf_counter()
+    count = load_and_check(load, storage)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    load_and_check(load, storage)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return count / elapsed, peak / count
+
+
+def main(count):
+    rnd = random.Random(42)
+    now = datetime.now(timezone.utc)
+    with tempfile.TemporaryDirectory() as directory:
+        storage = SqliteStorage(os.path.join(directory, "messages.db"))
+        storage.store_messages([make_row(i, rnd, now) for i in range(1, count + 1)])
+
+        results = {"full": measure(load_full, storage), "projected": measure(load_projected, storage)}
+        storage.close_connection()
+
+    base_rate, base_memory = results["full"]
+    print(f"{'loading':>10} {'rows/s':>10} {'bytes/row':>10} {'speed':>7} {'memory':>7}")
+    for name, (rate, memory) in results.items():
+        print(f"{name:>10} {rate:>10.0f} {memory:>10.0f} {rate / base_rate:>6.1f}x {base_memory / memory:>6.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,82 @@
+"""Compares startup with and without the scan data snapshot.
+
+"files" loads the scan data files and builds the matcher as every run did before; "snapshot" maps the snapshot
+written by the first run. Scan data files are generated in a temporary directory, matches of both are compared.
+
+Usage: python scripts/bench_scan_data_startup.py [entry counts...]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_matcher import PATTERN_TYPES, make_messages, messages_per_second, random_word
+from cleanup.config.scan_config import Config
+from cleanup.docextract.scan_data import ScanData, ScanDataType
+from cleanup.docextract.scan_matcher import ScanDataMatcher
+from cleanup.docextract.scan_snapshot import load_scan_data
+
+
+def write_scan_data(directory, count, rnd):
+    suffixes = Config().paths.scan_data_suffixes
+    suffix_by_type = {
+        ScanDataType.TG_USERNAME: suffixes.telegram_usernames,
+        ScanDataType.TG_USER_NAME: suffixes.telegram_user_names,
+        ScanDataType.TG_KEYWORD: suffixes.telegram_keywords,
+        ScanDataType.TG_URL: suffixes.telegram_urls,
+        ScanDataType.INSTAGRAM_USERNAME: suffixes.instagram_usernames,
+    }
+    lines = {data_type: [] for data_type in PATTERN_TYPES}
+    for i in range(count):
+        data_type = PATTERN_TYPES[i % len(PATTERN_TYPES)]
+        data = random_word(rnd)
+        lines[data_type].append(f"https://{data}.example.com/{i}" if data_type == ScanDataType.TG_URL else data)
+    for data_type, values in lines.items():
+        with open(os.path.join(directory, f"bench-{suffix_by_type[data_type]}"), 'w') as f:
+            f.write("\n".join(values) + "\n")
+
+
+def load_files(config):
+    scan_data = ScanData(config).load()
+    scan_data.matcher = ScanDataMatcher(scan_data)
+    return scan_data
+
+
+def timed(load, config):
+    start = time.perf_counter()
+    scan_data = load(config)
+    return scan_data, time.perf_counter() - start
+
+
+def main(counts):
+    rnd = random.Random(42)
+    print(f"{'entries':>10} {'files, s':>10} {'first run, s':>13} {'snapshot, s':>12} {'speedup':>8} "
+          f"{'files msg/s':>12} {'snapshot msg/s':>15}")
+    for count in counts:
+        with tempfile.TemporaryDirectory() as directory:
+            config = Config()
+            config.paths.scan_data_dir = os.path.join(directory, "scan-data")
+            config.paths.cache_dir = os.path.join(directory, "cache")
+            os.makedirs(config.paths.scan_data_dir)
+            write_scan_data(config.paths.scan_data_dir, count, rnd)
+
+            built, files_time = timed(load_files, config)
+            _, first_time = timed(load_scan_data, config)
+            mapped, snapshot_time = timed(load_scan_data, config)
+
+            messages = make_messages(built, 2000, rnd)
+            for message in messages:
+                assert [e.to_dict() for e in mapped.matcher.find(message)] == \
+                       [e.to_dict() for e in built.matcher.find(message)]
+
+            files_rate = messages_per_second(built.matcher.find, messages)
+            snapshot_rate = messages_per_second(mapped.matcher.find, messages)
+            print(f"{count:>10} {files_time:>10.2f} {first_time:>13.2f} {snapshot_time:>12.3f} "
+                  f"{files_time / snapshot_time:>7.0f}x {files_rate:>12.0f} {snapshot_rate:>15.0f}")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,191 @@
+"""Measures recall and lookup latency of fuzzy title matching against the exact name lookup it extends.
+
+Titles are made from the names of the tg-user-names scan data files the way they show up in chats: other quotes
+and emoji, Latin look-alike letters, transliteration, typos and swapped letters. Unrelated titles show false
+matches. The linear scan is the same comparison over every name, timed on a sample of lookups; the indexed lookup
+has to find a name as close as the linear scan does for every sampled typo and swap, the script fails otherwise.
+
+Usage: python scripts/bench_title_matcher.py [names file...]
+Without arguments the *tg-user-names.txt files of the config.yaml scan data dir are used, or generated names.
+"""
+import glob
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from cleanup.config.scan_config import load_config
+from cleanup.docextract.scan_data import ScanDataEntry, ScanDataIndex, ScanDataType
+from cleanup.docextract.title_matcher import (CHARS_PER_EDIT, LATIN_TO_CYRILLIC, TRANSLITERATION, allowed_edits,
+                                              bounded_distance, letter_count, normalize_title, title_words)
+
+CYRILLIC_WORDS = ["новости", "минск", "беларусь", "канал", "чат", "сейчас", "правда", "голос", "народ", "свобода",
+                  "гомель", "брест", "гродно", "витебск", "могилёв", "сводки", "live", "инфо", "город", "события"]
+EMOJI = ["🔥", "⚡️", "🇧🇾", "❗️", "📢", "🤍❤️🤍"]
+QUOTES = [('«', '»'), ('"', '"'), ('“', '”'), ("'", "'"), ('„', '“')]
+CYRILLIC_LOOK_ALIKES = {cyrillic: latin for latin, cyrillic in LATIN_TO_CYRILLIC.items()}
+
+
+def load_names(paths):
+    names = []
+    for path in paths:
+        with open(path, 'r') as f:
+            names.extend(line.strip() for line in f if line.strip())
+    return names
+
+
+def generate_names(count, rnd):
+    # words of Cyrillic syllables, with common words of channel names mixed in
+    syllables = [consonant + vowel for consonant in "бвгдзклмнпрстхчш" for vowel in "аеиоуыя"]
+    names = []
+    for i in range(count):
+        words = ["".join(rnd.choice(syllables) for _ in range(rnd.randint(2, 4))) for _ in range(rnd.randint(1, 3))]
+        if rnd.random() < 0.5:
+            words.insert(rnd.randint(0, len(words)), rnd.choice(CYRILLIC_WORDS))
+        names.append(" ".join(words))
+    return names
+
+
+def with_quotes_and_emoji(name, rnd):
+    opening, closing = rnd.choice(QUOTES)
+    return f"{rnd.choice(EMOJI)} {opening}{name.title()}{closing} {rnd.choice(EMOJI)}"
+
+
+def with_look_alikes(name, rnd):
+    return "".join(CYRILLIC_LOOK_ALIKES.get(ch, ch) if rnd.random() < 0.5 else ch for ch in name.lower()).upper()
+
+
+def transliterated(name, rnd):
+    return "".join(TRANSLITERATION.get(ch, ch) for ch in name.lower())
+
+
+def with_typos(name, rnd):
+    chars = list(name)
+    for _ in range(max(1, min(2, len(normalize_title(name)) // CHARS_PER_EDIT))):
+        i = rnd.randrange(len(chars))
+        operation = rnd.choice(("replace", "delete", "insert", "swap"))
+        if operation == "replace":
+            chars[i] = rnd.choice("абвгдеклмнопрст")
+        elif operation == "delete" and len(chars) > 1:
+            del chars[i]
+        elif operation == "insert":
+            chars.insert(i, rnd.choice("абвгдеклмнопрст"))
+        elif i + 1 < len(chars):
+            chars[i], chars[i + 1] = chars[i + 1], chars[i]
+    return "".join(chars)
+
+
+def with_swaps(name, rnd):
+    chars = list(name)
+    for _ in range(max(1, min(2, len(normalize_title(name)) // CHARS_PER_EDIT))):
+        i = rnd.randrange(max(1, len(chars) - 1))
+        chars[i:i + 2] = chars[i:i + 2][::-1]
+    return "".join(chars)
+
+
+VARIANTS = {
+    "exact": lambda name, rnd: name,
+    "quotes, emoji": with_quotes_and_emoji,
+    "look-alikes": with_look_alikes,
+    "transliterated": transliterated,
+    "typos": with_typos,
+    "swaps": with_swaps,
+}
+
+
+def linear_find(entries, title, max_distance):
+    words = title_words(title)
+    query = " ".join(word for word, _ in words)
+    max_edits = min(max_distance, letter_count(words) // CHARS_PER_EDIT)
+    best, best_distance = None, max_edits + 1
+    for entry, name in entries:
+        if name == query:
+            return entry
+        limit = min(allowed_edits(words, name, max_edits), best_distance - 1)
+        if limit <= 0:
+            continue
+        distance = bounded_distance(query, name, limit)
+        if distance <= limit:
+            best, best_distance = entry, distance
+    return best
+
+
+def distance_to(title, entry, max_distance):
+    if entry is None:
+        return max_distance + 1
+    return bounded_distance(normalize_title(title), normalize_title(entry.data), max_distance)
+
+
+def count_missed(index, entries, titles, max_distance=2):
+    """Titles the linear scan finds a closer name for than the indexed lookup."""
+    missed = 0
+    for title in titles:
+        expected = distance_to(title, linear_find(entries, title, max_distance), max_distance)
+        missed += distance_to(title, index.find_similar_name(title, max_distance=max_distance), max_distance) > expected
+    return missed
+
+
+def lookup_times(find, titles):
+    times = []
+    for title in titles:
+        start = time.perf_counter()
+        find(title)
+        times.append(time.perf_counter() - start)
+    return statistics.mean(times) * 1e6, sorted(times)[int(len(times) * 0.99)] * 1e6
+
+
+def main(paths):
+    rnd = random.Random(42)
+    if not paths:
+        config, _ = load_config("config.yaml")
+        paths = glob.glob(os.path.join(config.paths.scan_data_dir, f"*{config.paths.scan_data_suffixes.telegram_user_names}"))
+    names = load_names(paths) if paths else generate_names(20000, rnd)
+    print(f"{len(names)} names from {', '.join(paths) if paths else 'the generator'}")
+
+    index = ScanDataIndex({ScanDataType.TG_USER_NAME: [ScanDataEntry(name, ScanDataType.TG_USER_NAME) for name in names]})
+    start = time.perf_counter()
+    index.find_similar_name("")
+    print(f"index built in {time.perf_counter() - start:.2f}s, {len(index.titles)} normalized names, "
+          f"{len(index.titles.postings)} trigrams")
+
+    sample = rnd.sample(sorted(index.names.values(), key=lambda entry: entry.data), min(2000, len(index.names)))
+    print(f"{'variant':>15} {'exact recall':>13} {'fuzzy recall':>13}")
+    fuzzy_titles = []
+    edited_titles = []
+    for variant, make in VARIANTS.items():
+        exact_hits = fuzzy_hits = 0
+        for entry in sample:
+            title = make(entry.data, rnd)
+            fuzzy_titles.append(title)
+            if make in (with_typos, with_swaps):
+                edited_titles.append(title)
+            exact_hits += index.find_name(title) is entry
+            found = index.find_similar_name(title)
+            fuzzy_hits += found is not None and normalize_title(found.data) == normalize_title(entry.data)
+        print(f"{variant:>15} {exact_hits / len(sample):>13.1%} {fuzzy_hits / len(sample):>13.1%}")
+
+    unrelated = generate_names(len(sample), random.Random(7))
+    known = set(index.titles.exact)
+    unrelated = [title for title in unrelated if normalize_title(title) not in known]
+    false_matches = sum(index.find_similar_name(title) is not None for title in unrelated)
+    print(f"unrelated titles matched: {false_matches / len(unrelated):.1%} of {len(unrelated)}")
+
+    indexed_mean, indexed_p99 = lookup_times(index.find_similar_name, fuzzy_titles)
+    entries = list(zip(index.titles.entries, index.titles.titles))
+    linear_sample = fuzzy_titles[::max(1, len(fuzzy_titles) // 200)]
+    linear_mean, linear_p99 = lookup_times(lambda title: linear_find(entries, title, 2), linear_sample)
+    print(f"{'lookup':>15} {'mean, us':>10} {'p99, us':>10}")
+    print(f"{'indexed':>15} {indexed_mean:>10.0f} {indexed_p99:>10.0f}")
+    print(f"{'linear scan':>15} {linear_mean:>10.0f} {linear_p99:>10.0f}")
+
+    checked = edited_titles[::max(1, len(edited_titles) // 400)]
+    missed = count_missed(index, entries, checked)
+    print(f"typos and swaps the indexed lookup missed: {missed} of {len(checked)}")
+    assert missed == 0, "the trigram filter dropped a name within the allowed edits"
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,95 @@
+"""Checks the takeout setup of the online scan against a fake client, no Telegram connection needed.
+
+An accepted takeout session fetches histories through the session without telethon's wait between requests; a
+session refused with TakeoutInitDelayError falls back to the normal client and its default wait.
+
+Usage: python scripts/check_takeout.py
+"""
+import asyncio
+import os
+import sys
+from contextlib import AsyncExitStack
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from telethon.errors import TakeoutInitDelayError
+
+from cleanup.config.scan_config import Config
+from cleanup.docextract.scan_data import ScanData
+from cleanup.main_tg import TelegramScanner
+
+
+class FakeClient:
+    """Records the history requests, the takeout session is a FakeClient too."""
+
+    def __init__(self, takeout_delay=None):
+        self.takeout_delay = takeout_delay
+        self.session = None
+        self.history_requests = []
+        self.closed = False
+
+    def takeout(self, **kwargs):
+        return FakeTakeout(self)
+
+    async def iter_messages(self, chat, **kwargs):
+        self.history_requests.append(kwargs)
+        return
+        yield
+
+
+class FakeTakeout:
+    def __init__(self, client):
+        self.client = client
+
+    async def __aenter__(self):
+        if self.client.takeout_delay is not None:
+            raise TakeoutInitDelayError(None, capture=self.client.takeout_delay)
+        self.client.session = FakeClient()
+        return self.client.session
+
+    async def __aexit__(self, *exc_info):
+        self.client.session.closed = True
+
+
+def create_scanner():
+    config = Config()
+    config.telegram.api_id, config.telegram.api_hash = 1, 'hash'
+    config.telegram.cache_messages = config.telegram.cache_peers = False
+    return TelegramScanner(config, ScanData(config))
+
+
+async def scan_history(scanner, client):
+    chat = SimpleNamespace(id=1)
+    return await scanner.clean_chat(chat, client, current_user_id=1, dialog_id=1, dialog_name='chat')
+
+
+async def check_accepted():
+    scanner, client = create_scanner(), FakeClient()
+    async with AsyncExitStack() as stack:
+        fetch_client = await scanner.open_takeout(client, stack)
+        assert fetch_client is client.session and scanner.fetch_client is fetch_client
+        await scan_history(scanner, client)
+    assert not client.history_requests, "history was fetched with the normal client"
+    assert [request['wait_time'] for request in fetch_client.history_requests] == [0]
+    assert fetch_client.closed, "takeout session wasn't closed with the stack"
+
+
+async def check_refused():
+    scanner, client = create_scanner(), FakeClient(takeout_delay=86400)
+    async with AsyncExitStack() as stack:
+        fetch_client = await scanner.open_takeout(client, stack)
+        assert fetch_client is client and scanner.fetch_client is client
+        await scan_history(scanner, client)
+    assert client.session is None
+    assert [request['wait_time'] for request in client.history_requests] == [None]
+
+
+async def main():
+    await check_accepted()
+    await check_refused()
+    print("Takeout accepted and refused cases passed")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())